@@ -1,17 +1,26 @@
 from flask import Blueprint, request, jsonify
-import sqlite3, os, json, time
+import re
+import time
+import orjson
+from functools import lru_cache
 from ai_classifier import classify, CATEGORIES
-
-ROOT = os.path.dirname(__file__)
-DB_PATH = os.path.join(ROOT, "gschool.db")
+from db_pool import pool, writer, settings_cache
 
 ai = Blueprint("ai", __name__, url_prefix="/api/ai")
 
-def _db():
-    return sqlite3.connect(DB_PATH)
+def _seed_categories(conn):
+    """Insert any missing CATEGORIES (single executemany; caller owns the transaction)."""
+    conn.executemany("INSERT OR IGNORE INTO categories(name, blocked, block_url) VALUES(?,0,NULL)",
+                     [(c,) for c in CATEGORIES])
+
+_SCHEMA_READY = False
 
 def ensure_schema():
-    with _db() as conn:
+    """Create tables and seed categories. Runs once per process, at import."""
+    global _SCHEMA_READY
+    if _SCHEMA_READY:
+        return
+    def create(conn):
         cur = conn.cursor()
         # Tables
         cur.execute("""CREATE TABLE IF NOT EXISTS categories(
@@ -23,6 +32,7 @@ def ensure_schema():
             k TEXT PRIMARY KEY,
             v TEXT
         )""")
+        cur.execute("CREATE TABLE IF NOT EXISTS overrides (k TEXT PRIMARY KEY, v TEXT)")
         cur.execute("""CREATE TABLE IF NOT EXISTS chat_messages(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             room TEXT,
@@ -31,99 +41,113 @@ def ensure_schema():
             text TEXT,
             ts INTEGER
         )""")
-        conn.commit()
+        # chat_poll filters by room and ts range; keep it an index range scan.
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_room_ts ON chat_messages(room, ts)")
 
         # Seed categories if any missing
-        cur.execute("SELECT name FROM categories")
-        existing = {r[0] for r in cur.fetchall()}
-        for c in CATEGORIES:
-            if c not in existing:
-                cur.execute("INSERT OR IGNORE INTO categories(name, blocked, block_url) VALUES(?,?,?)", (c, 0, None))
-        conn.commit()
+        _seed_categories(conn)
+    writer.run(create)
+    _SCHEMA_READY = True
+
+# Schema is fixed at runtime, so build it once when the blueprint module loads.
+try:
+    ensure_schema()
+except Exception as _e:
+    print("[WARN] ai_routes schema init failed:", _e)
+
+_SETTING_GET_SQL = "SELECT v FROM settings WHERE k=?"
+_SETTING_SET_SQL = "INSERT OR REPLACE INTO settings(k,v) VALUES(?,?)"
 
 def get_setting(key, default=None):
-    with _db() as conn:
+    with pool.checkout() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT v FROM settings WHERE k=?", (key,))
+        cur.execute(_SETTING_GET_SQL, (key,))
         row = cur.fetchone()
-        return json.loads(row[0]) if row and row[0] else default
+        return orjson.loads(row[0]) if row and row[0] else default
 
 def set_setting(key, value):
-    with _db() as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO settings(k,v) VALUES(?,?)", (key, json.dumps(value)))
-        conn.commit()
+    writer.execute(_SETTING_SET_SQL, (key, orjson.dumps(value).decode()))
+    settings_cache.invalidate(("setting", key))
+
+# One round-trip for everything classify needs; rows are tagged 'cat' or 'ov'.
+_CLASSIFY_RULES_SQL = (
+    "SELECT 'cat', name, blocked, block_url FROM categories WHERE name IN (?, ?) "
+    "UNION ALL SELECT 'ov', k, NULL, v FROM overrides WHERE k='allowlist'"
+)
+
+def _classify_rules(category):
+    """(allowlist, global_block_on, cat_blocked, cat_block_url) for a category."""
+    def load():
+        allowlist, rules = [], {}
+        with pool.checkout() as conn:
+            for tag, name, blocked, val in conn.execute(_CLASSIFY_RULES_SQL, ("Global Block All", category)):
+                if tag == "ov":
+                    allowlist = orjson.loads(val) if val else []
+                else:
+                    rules[name] = (bool(blocked), val)
+        global_rule = rules.get("Global Block All")
+        rule = rules.get(category)
+        return (allowlist,
+                bool(global_rule and global_rule[0]),
+                rule[0] if rule else False,
+                rule[1] if rule else None)
+    return settings_cache.get_or_load(("classify", category), load)
 
 @ai.route("/categories", methods=["GET", "POST"])
 def categories():
-    ensure_schema()
-    with _db() as conn:
+    # Update category (same frontend behavior)
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        name = body.get("name")
+        blocked = 1 if body.get("blocked") else 0
+        block_url = body.get("block_url")
+        if not name:
+            return jsonify({"ok": False, "error": "name required"}), 400
+        def upsert(conn):
+            conn.execute("INSERT OR IGNORE INTO categories(name, blocked, block_url) VALUES(?,?,?)",
+                         (name, blocked, block_url))
+            conn.execute("UPDATE categories SET blocked=?, block_url=? WHERE name=?",
+                         (blocked, block_url, name))
+        writer.run(upsert)
+        # "Global Block All" feeds every classify entry, so drop them all.
+        settings_cache.invalidate()
+        return jsonify({"ok": True})
+
+    # Missing categories are seeded by ensure_schema() at import.
+    with pool.checkout() as conn:
         cur = conn.cursor()
-
-        # Update category (same frontend behavior)
-        if request.method == "POST":
-            body = request.json or {}
-            name = body.get("name")
-            blocked = 1 if body.get("blocked") else 0
-            block_url = body.get("block_url")
-            if not name:
-                return jsonify({"ok": False, "error": "name required"}), 400
-            cur.execute("INSERT OR IGNORE INTO categories(name, blocked, block_url) VALUES(?,?,?)",
-                        (name, blocked, block_url))
-            cur.execute("UPDATE categories SET blocked=?, block_url=? WHERE name=?",
-                        (blocked, block_url, name))
-            conn.commit()
-            return jsonify({"ok": True})
-
-        # Auto-add any missing categories silently
-        cur.execute("SELECT name FROM categories")
-        existing = {r[0] for r in cur.fetchall()}
-        for c in CATEGORIES:
-            if c not in existing:
-                cur.execute("INSERT OR IGNORE INTO categories(name, blocked, block_url) VALUES(?,?,?)", (c, 0, None))
-        conn.commit()
-
         # Return exactly what frontend expects
         cur.execute("SELECT name, blocked, block_url FROM categories ORDER BY name")
         rows = [{"name": n, "blocked": bool(b), "block_url": u} for (n, b, u) in cur.fetchall()]
         return jsonify({"ok": True, "categories": rows})
 
+_ALLOWED_DOMAINS = ("blocked.gdistrict.org",)
+
+@lru_cache(maxsize=32)
+def _allow_pattern(entries):
+    """One compiled alternation for a tuple of allowlist entries (lowercased substrings)."""
+    return re.compile("|".join(re.escape(a.lower()) for a in entries))
+
 @ai.route("/classify", methods=["POST"])
 def api_classify():
-    ensure_schema()
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     url = body.get("url") or ""
     html = body.get("html")
     result = classify(url, html)
 
     # --- Load settings ---
-    default_redirect = get_setting("blocked_redirect", "https://blocked.gdistrict.org/Gschool%20block")
-    with _db() as conn:
-        cur = conn.cursor()
-
-        # Get global allowlist
-        cur.execute("CREATE TABLE IF NOT EXISTS overrides (k TEXT PRIMARY KEY, v TEXT)")
-        conn.commit()
-        cur.execute("SELECT v FROM overrides WHERE k='allowlist'")
-        row = cur.fetchone()
-        allowlist = json.loads(row[0]) if row and row[0] else []
-
-        # Check if "Global Block All" is active
-        cur.execute("SELECT blocked FROM categories WHERE name=?", ("Global Block All",))
-        row = cur.fetchone()
-        global_block_on = bool(row and row[0])
-
-        # Get normal category rule
-        cur.execute("SELECT blocked, block_url FROM categories WHERE name=?", (result["category"],))
-        row = cur.fetchone()
-        cat_blocked = bool(row[0]) if row else False
-        cat_block_url = row[1] if row else None
+    default_redirect = settings_cache.get_or_load(
+        ("setting", "blocked_redirect"),
+        lambda: get_setting("blocked_redirect", "https://blocked.gdistrict.org/Gschool%20block"))
+    # Global allowlist, "Global Block All" flag and this category's rule
+    allowlist, global_block_on, cat_blocked, cat_block_url = _classify_rules(result["category"])
 
     # --- Handle Global Block All Mode ---
-    allowed_domains = ["blocked.gdistrict.org"]
     if global_block_on:
-        # Check if URL is in allowlist or allowed domains
-        allowed = any(a.lower() in url.lower() for a in allowlist + allowed_domains)
+        # Check if URL is in allowlist or allowed domains. Keyed on the list
+        # contents, so an edited overrides row compiles a fresh pattern.
+        pattern = _allow_pattern(tuple(allowlist) + _ALLOWED_DOMAINS)
+        allowed = pattern.search(url.lower()) is not None
         if not allowed:
             return jsonify({
                 "ok": True,
@@ -146,10 +170,19 @@ def api_classify():
     })
 
 
+_CHAT_INSERT_SQL = "INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)"
+# Paged by id, not ts: several messages can share a millisecond, and the writer
+# assigns ids in commit order, so id>last_id never skips or repeats a row.
+_CHAT_POLL_SQL = "SELECT id, user_id, role, text, ts FROM chat_messages WHERE room=? AND id>? ORDER BY id LIMIT ?"
+# Older clients that only send since=<ts> get their first page by ts, then follow last_id.
+_CHAT_POLL_TS_SQL = "SELECT id, user_id, role, text, ts FROM chat_messages WHERE room=? AND ts>? ORDER BY id LIMIT ?"
+# Max messages per poll; clients page forward with after_id=<last_id> while "more" is true.
+_CHAT_POLL_LIMIT = 500
+
+
 @ai.route("/chat/send", methods=["POST"])
 def chat_send():
-    ensure_schema()
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     room = b.get("room") or "*"
     user_id = b.get("user_id") or "unknown"
     role = b.get("role") or "student"
@@ -157,21 +190,28 @@ def chat_send():
     if not text:
         return jsonify({"ok": False, "error": "empty"}), 400
     ts = int(time.time() * 1000)
-    with _db() as conn:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
-                    (room, user_id, role, text, ts))
-        conn.commit()
+    # Queued on the writer thread; concurrent sends share one commit.
+    writer.enqueue(_CHAT_INSERT_SQL, (room, user_id, role, text, ts))
     return jsonify({"ok": True, "ts": ts})
 
 @ai.route("/chat/poll", methods=["GET"])
 def chat_poll():
-    ensure_schema()
     room = request.args.get("room", "*")
+    after_id = request.args.get("after_id")
     since = int(request.args.get("since", "0") or 0)
-    with _db() as conn:
+    if after_id is not None:
+        sql, cursor = _CHAT_POLL_SQL, int(after_id or 0)
+    else:
+        sql, cursor = _CHAT_POLL_TS_SQL, since
+    with pool.checkout() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT user_id, role, text, ts FROM chat_messages WHERE room=? AND ts>? ORDER BY ts ASC",
-                    (room, since))
-        rows = [{"user_id": u, "role": r, "text": t, "ts": ts} for (u, r, t, ts) in cur.fetchall()]
-    return jsonify({"ok": True, "messages": rows})
+        # One extra row tells us whether another page exists.
+        cur.execute(sql, (room, cursor, _CHAT_POLL_LIMIT + 1))
+        fetched = cur.fetchmany(_CHAT_POLL_LIMIT + 1)
+    more = len(fetched) > _CHAT_POLL_LIMIT
+    page = fetched[:_CHAT_POLL_LIMIT]
+    rows = [{"user_id": u, "role": r, "text": t, "ts": ts} for (_, u, r, t, ts) in page]
+    # null until a since= poll returns a row; keep polling by ts until then
+    last_id = page[-1][0] if page else (cursor if after_id is not None else None)
+    last_ts = rows[-1]["ts"] if rows else since
+    return jsonify({"ok": True, "messages": rows, "more": more, "last_id": last_id, "last_ts": last_ts})
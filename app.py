@@ -2,10 +2,17 @@
 # G-SCHOOLS CONNECT BACKEND
 # =========================
 
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, send_from_directory, g
 from flask_cors import CORS
-import json, os, time, sqlite3, traceback, uuid, re
+from flask.json.provider import DefaultJSONProvider
+import json, os, time, sqlite3, traceback, uuid, re, threading, hashlib, atexit, heapq, base64, binascii
+import orjson
 from urllib.parse import urlparse
+from collections import defaultdict, deque, OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from concurrent.futures import TimeoutError as FutureTimeout
+from db_pool import pool, writer, settings_cache, DB_PATH, PRAGMAS
 
 # ---------------------------
 # Flask App Initialization
@@ -14,6 +21,32 @@ app = Flask(__name__, static_url_path="/static", static_folder="static", templat
 app.secret_key = os.environ.get("SECRET_KEY", "dev_secret_key")
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+# Request bodies above this are rejected with 413 before any parsing
+# (heartbeats carrying screenshots are the largest legitimate posts).
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_CONTENT_LENGTH", 16 * 1024 * 1024))
+
+class _JSONProvider(DefaultJSONProvider):
+    """jsonify()/request JSON through orjson; deques (capped logs) encode as lists."""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, deque):
+            return list(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = _JSONProvider(app)
+
+@app.before_request
+def _stamp_request():
+    # One clock read per request; handlers stamp entries with g.now.
+    g.now = int(time.time())
+
 def _ice_servers():
     # Always include Google STUN
     servers = [{"urls": ["stun:stun.l.google.com:19302"]}]
@@ -32,8 +65,8 @@ def _ice_servers():
 
 ROOT = os.path.dirname(__file__)
 DATA_PATH = os.path.join(ROOT, "data.json")
-DB_PATH = os.path.join(ROOT, "gschool.db")
 SCENES_PATH = os.path.join(ROOT, "scenes.json")
+SHOTS_DIR = os.path.join(ROOT, "screenshots")
 
 
 # =========================
@@ -43,6 +76,10 @@ SCENES_PATH = os.path.join(ROOT, "scenes.json")
 def db():
     """Open sqlite connection (row factory stays default to keep light)."""
     con = sqlite3.connect(DB_PATH)
+    # Same WAL/synchronous/busy_timeout settings as the pool; _init_db runs
+    # first at import, so the file is switched to WAL before any request.
+    for p in PRAGMAS:
+        con.execute(p)
     return con
 
 def _init_db():
@@ -72,11 +109,46 @@ def _init_db():
             ts INTEGER
         );
     """)
+    # App state: one JSON document per top-level data key (replaces data.json)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS state (
+            k TEXT PRIMARY KEY,
+            v TEXT
+        );
+    """)
+    # Audit log: append-only, one JSON entry per row
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS audit (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts INTEGER,
+            entry TEXT
+        );
+    """)
+    # Append-only event streams (hands, exam violations, class chat); the
+    # store keeps only a recent tail of each, like audit
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            scope TEXT,
+            student TEXT,
+            ts INTEGER,
+            entry TEXT
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_events_kind ON events(kind, scope, student)")
+    # Chat rooms are polled by ts (/api/ai/chat/poll?since=)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_room_ts ON chat_messages(room, ts)")
+    # DM threads and chat polls page forward by id (?after_id=)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_room_id ON chat_messages(room, id)")
     con.commit()
     con.close()
 
 _init_db()
 
+# Audit entries kept; older ones fall off the deque as new ones arrive.
+_AUDIT_MAX = 500
+
 def _safe_default_data():
     return {
         "settings": {"chat_enabled": False},
@@ -99,7 +171,7 @@ def _safe_default_data():
         "screenshots": {},
         "dm": {},
         "alerts": [],
-        "audit": []
+        "audit": deque(maxlen=_AUDIT_MAX)
     }
 
 def _coerce_to_dict(obj):
@@ -115,16 +187,32 @@ def _coerce_to_dict(obj):
         return d
     return _safe_default_data()
 
-def load_data():
-    """Load JSON with self-repair for common corruption patterns."""
+# Hot statements kept as constants so the pooled connections' caches reuse them.
+_SETTING_GET_SQL = "SELECT v FROM settings WHERE k=?"
+_SETTING_SET_SQL = "REPLACE INTO settings (k, v) VALUES (?,?)"
+_STATE_UPSERT_SQL = "REPLACE INTO state (k, v) VALUES (?,?)"
+_AUDIT_INSERT_SQL = "INSERT INTO audit (ts, entry) VALUES (?,?)"
+_AUDIT_TRIM_SQL = "DELETE FROM audit WHERE id <= (SELECT max(id) FROM audit) - ?"
+_CHAT_INSERT_SQL = "INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)"
+_EVENT_INSERT_SQL = "INSERT INTO events (kind, scope, student, ts, entry) VALUES (?,?,?,?,?)"
+_EVENT_TRIM_SQL = (
+    "DELETE FROM events WHERE kind=? AND scope=? AND id NOT IN "
+    "(SELECT id FROM events WHERE kind=? AND scope=? ORDER BY id DESC LIMIT ?)"
+)
+
+# Event streams stored one row per event in the events table: kind -> size
+# of the in-memory tail. Scoped kinds keep one tail per scope, e.g.
+# d["chat"][class_id] and d["pending_per_student"][student].
+_EVENT_CAPS = {"raises": 200, "exam_violations": 500, "chat": 200, "pending_per_student": 50}
+_SCOPED_EVENTS = ("chat", "pending_per_student")
+
+def _load_legacy_json():
+    """Read data.json (pre-SQLite store) with self-repair for common corruption patterns."""
     if not os.path.exists(DATA_PATH):
-        d = _safe_default_data()
-        save_data(d)
-        return d
+        return _safe_default_data()
     try:
         with open(DATA_PATH, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-            return ensure_keys(_coerce_to_dict(obj))
+            return _coerce_to_dict(json.load(f))
     except json.JSONDecodeError as e:
         # Try simple auto-repair: merge stray blocks like "} {"
         try:
@@ -135,40 +223,249 @@ def load_data():
                 text = "[" + text
             if not text.endswith("]"):
                 text = text + "]"
-            arr = json.loads(text)
-            obj = _coerce_to_dict(arr)
-            save_data(obj)
-            return ensure_keys(obj)
+            return _coerce_to_dict(json.loads(text))
         except Exception:
             print("[FATAL] data.json unrecoverable; starting fresh:", e)
-            obj = _safe_default_data()
-            save_data(obj)
-            return obj
+            return _safe_default_data()
     except Exception as e:
-        print("[WARN] load_data failed; using defaults:", e)
-        return ensure_keys(_safe_default_data())
+        print("[WARN] data.json load failed; using defaults:", e)
+        return _safe_default_data()
+
+# Last JSON written for each state row, so flushes only rewrite keys that changed.
+_STATE_ROWS = {}
+
+# Per-student buckets stored one row per student ("history/<email>"), so a
+# heartbeat rewrites that student's presence and timeline instead of every student's.
+_SHARDED_KEYS = ("presence", "history", "screenshots")
+
+def _read_state_rows():
+    """Load state rows as-is; on first run (empty table) fall back to data.json."""
+    with pool.checkout() as con:
+        rows = con.execute("SELECT k, v FROM state").fetchall()
+    if not rows:
+        return _load_legacy_json()
+    d = {}
+    for k, v in rows:
+        try:
+            val = orjson.loads(v)
+        except ValueError as e:
+            print(f"[WARN] state row {k!r} unreadable; resetting:", e)
+            continue
+        _STATE_ROWS[k] = v
+        top, _, student = k.partition("/")
+        if student and top in _SHARDED_KEYS:
+            d.setdefault(top, {})[student] = val
+        elif k in _SHARDED_KEYS:
+            # Pre-sharding single row; split on the next flush.
+            for student, arr in (val or {}).items():
+                d.setdefault(k, {}).setdefault(student, arr)
+        elif k == "audit":
+            d[k] = deque(val, maxlen=_AUDIT_MAX)
+        else:
+            d[k] = val
+    return d
 
-def save_data(d):
-    d = ensure_keys(_coerce_to_dict(d))
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(d, f, indent=2)
+def _iter_state_rows(d):
+    for k, v in list(d.items()):
+        if k == "audit" or k in _EVENT_CAPS:
+            continue  # own tables; the store only holds the recent tail
+        if k in _SHARDED_KEYS and isinstance(v, dict):
+            for student, arr in list(v.items()):
+                yield f"{k}/{student}", arr
+        else:
+            yield k, v
+
+def _named_state_rows(d, rows):
+    """(key, value) for the named rows that still exist; "presence/<email>" is one
+    student's shard, a bare sharded key stands for all of its students."""
+    for k in rows:
+        top, _, student = k.partition("/")
+        v = d.get(top)
+        if student:
+            if isinstance(v, dict) and student in v:
+                yield k, v[student]
+        elif k in _SHARDED_KEYS and isinstance(v, dict):
+            for student, arr in list(v.items()):
+                yield f"{k}/{student}", arr
+        elif k in d:
+            yield k, v
+
+def _write_state_rows(d, rows=None):
+    """Upsert only the rows whose serialized value changed, in one transaction.
+
+    rows names the keys written since the last flush (see save_data); only
+    those are serialized. None checks every row.
+    """
+    if rows is None:
+        items, stale = _iter_state_rows(d), _STATE_ROWS
+    else:
+        items = _named_state_rows(d, rows)
+        stale = [k for k in _STATE_ROWS if k in rows or k.partition("/")[0] in rows]
+    changed, seen = [], set()
+    for k, v in items:
+        seen.add(k)
+        raw = orjson.dumps(v, default=list, option=orjson.OPT_NON_STR_KEYS).decode()  # default: audit deque
+        if _STATE_ROWS.get(k) != raw:
+            changed.append((k, raw))
+    gone = [(k,) for k in stale if k not in seen]
+    if not changed and not gone:
+        return
+    def write(con):
+        con.executemany(_STATE_UPSERT_SQL, changed)
+        con.executemany("DELETE FROM state WHERE k=?", gone)
+    writer.run(write)
+    _STATE_ROWS.update(changed)
+    for (k,) in gone:
+        _STATE_ROWS.pop(k, None)
+
+class _Store:
+    """Process-wide live copy of the state rows (the app runs as a single process).
+
+    load_data() hands every handler the same dict and save_data() only marks
+    it dirty; one flusher thread wakes on the first mark, waits FLUSH_DELAY
+    for the rest of the burst, then writes the changed rows once. Marks that
+    name their rows keep the flush to those rows; any unnamed mark (and the
+    first flush after boot) checks them all.
+    """
+
+    FLUSH_DELAY = 0.25
+
+    def __init__(self):
+        self.data = None
+        self.dirty = False
+        self._dirty_rows = None  # row keys marked since the last flush; None = all
+        self.version = 0  # bumped on every change; feeds the /api/state ETag
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def get(self):
+        if self.data is None:
+            with self._lock:
+                if self.data is None:
+                    self.data = _read_state_rows()
+        return self.data
+
+    def touch(self):
+        """Note a change that has no state rows to write (e.g. audit/event tails)."""
+        self.version += 1
+
+    def mark_dirty(self, rows=None):
+        with self._lock:
+            if rows is None:
+                self._dirty_rows = None
+            elif self._dirty_rows is not None:
+                self._dirty_rows.update(rows)
+        self.version += 1
+        self.dirty = True
+        self._wake.set()
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.FLUSH_DELAY)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            with self._lock:
+                rows, self._dirty_rows = self._dirty_rows, set()
+            try:
+                _write_state_rows(self.data, rows)
+            except RuntimeError:
+                # A handler resized a dict mid-serialization; try again shortly.
+                self.mark_dirty(rows)
+            except Exception as e:
+                print("[WARN] state flush failed; will retry:", e)
+                self.mark_dirty(rows)
+
+_STORE = _Store()
+atexit.register(_STORE.flush)
+
+def load_data():
+    """The live state dict; mutate it in place and call save_data()."""
+    return _STORE.get()
+
+def save_data(d, rows=None):
+    """Schedule a write-back of the live state (d is the dict from load_data()).
+
+    Hot paths pass the row keys they touched, e.g. ("presence/<email>",), so
+    the flush serializes just those; without rows every row is diffed.
+    """
+    _STORE.mark_dirty(rows)
 
 def get_setting(key, default=None):
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT v FROM settings WHERE k=?", (key,))
-    row = cur.fetchone()
-    con.close()
+    with pool.checkout() as con:
+        row = con.execute(_SETTING_GET_SQL, (key,)).fetchone()
     if not row:
         return default
     try:
-        return json.loads(row[0])
+        return orjson.loads(row[0])
     except Exception:
         return row[0]
 
 def set_setting(key, value):
-    con = db(); cur = con.cursor()
-    cur.execute("REPLACE INTO settings (k, v) VALUES (?,?)", (key, json.dumps(value)))
-    con.commit(); con.close()
+    global _SETTINGS_VERSION
+    writer.execute(_SETTING_SET_SQL, (key, orjson.dumps(value).decode()))
+    settings_cache.invalidate(("setting", key))
+    _SETTINGS_VERSION += 1  # after the invalidate, so a rebuild at this version reads the new value
+    _STORE.touch()  # /api/state embeds the YouTube rules settings
+
+def _ojsonify(obj):
+    """jsonify() via orjson, for hot read endpoints (deques encode as lists)."""
+    return app.response_class(orjson.dumps(obj, default=list, option=orjson.OPT_NON_STR_KEYS),
+                              mimetype="application/json")
+
+def _conditional(resp, etag=None, weak=False):
+    """Tag a polled JSON response with an ETag (its body's md5 unless given);
+    304 with no body when the client's If-None-Match still matches."""
+    resp.set_etag(etag or hashlib.md5(resp.get_data()).hexdigest(), weak=weak)
+    return resp.make_conditional(request)
+
+_STREAM_CHUNK = 64 * 1024
+
+def _stream_json(head, parts, tail):
+    """Stream head + comma-joined parts + tail, encoding one part at a time.
+
+    Large bodies (presence, timeline, screenshots) never exist as a single
+    bytes object; output goes out in ~64KB chunks as it is encoded.
+    """
+    def gen():
+        buf = bytearray(head)
+        for i, part in enumerate(parts):
+            if i:
+                buf += b","
+            buf += part
+            if len(buf) >= _STREAM_CHUNK:
+                yield bytes(buf)
+                buf.clear()
+        buf += tail
+        yield bytes(buf)
+    return app.response_class(gen(), mimetype="application/json")
+
+def _stream_items(items):
+    """{"ok": true, "items": [...]} streamed item by item."""
+    parts = (orjson.dumps(it, option=orjson.OPT_NON_STR_KEYS) for it in items)
+    return _stream_json(b'{"ok":true,"items":[', parts, b"]}")
+
+def _stream_dict(obj):
+    """A flat-ish dict streamed one key at a time (snapshotted first: the store is live)."""
+    pairs = list(obj.items())
+    parts = (orjson.dumps(str(k)) + b":" + orjson.dumps(v, option=orjson.OPT_NON_STR_KEYS) for k, v in pairs)
+    return _stream_json(b"{", parts, b"}")
 
 def current_user():
     return session.get("user")
@@ -192,46 +489,182 @@ def ensure_keys(d):
     d.setdefault("screenshots", {})
     d.setdefault("alerts", [])
     d.setdefault("dm", {})
-    d.setdefault("audit", [])
+    d.setdefault("audit", deque(maxlen=_AUDIT_MAX))
+    d.setdefault("raises", [])
+    d.setdefault("exam_violations", [])
+    d.setdefault("chat", {})
     # also carry feature flags
     d.setdefault("extension_enabled", True)
     return d
 
-def log_action(entry):
+def _repair_data():
+    """Startup-only: import data.json on first run, add missing keys and persist the result."""
+    d = ensure_keys(_coerce_to_dict(_read_state_rows()))
+    with pool.checkout() as con:
+        rows = con.execute("SELECT entry FROM audit ORDER BY id DESC LIMIT ?", (_AUDIT_MAX,)).fetchall()
+    if rows:
+        d["audit"] = deque((orjson.loads(r[0]) for r in reversed(rows)), maxlen=_AUDIT_MAX)
+    elif d["audit"]:
+        # Entries from the old state row / data.json move into the audit table once.
+        writer.executemany(_AUDIT_INSERT_SQL, [(e.get("ts", 0), orjson.dumps(e).decode()) for e in d["audit"]])
+    _load_event_tails(d)
+    _STORE.data = d
+    _STORE.dirty = True
+    _STORE.flush()
+
+def _load_event_tails(d):
+    """Startup-only: fill the in-memory event tails from the events table."""
+    with pool.checkout() as con:
+        fresh = con.execute("SELECT 1 FROM events LIMIT 1").fetchone() is None
+        migrate = []
+        for kind, cap in _EVENT_CAPS.items():
+            if fresh or kind in _STATE_ROWS:
+                # Still held as a state row (or data.json): move it in once.
+                migrate.append(kind)
+            elif kind in _SCOPED_EVENTS:
+                rows = con.execute(
+                    "SELECT scope, entry FROM (SELECT scope, entry, id, ROW_NUMBER() OVER "
+                    "(PARTITION BY scope ORDER BY id DESC) AS n FROM events WHERE kind=?) "
+                    "WHERE n<=? ORDER BY id", (kind, cap)).fetchall()
+                d[kind] = {}
+                for scope, e in rows:
+                    d[kind].setdefault(scope, []).append(orjson.loads(e))
+            else:
+                rows = con.execute("SELECT entry FROM events WHERE kind=? ORDER BY id DESC LIMIT ?",
+                                   (kind, cap)).fetchall()
+                d[kind] = [orjson.loads(r[0]) for r in reversed(rows)]
+    rows = []
+    for kind in migrate:
+        if kind in _SCOPED_EVENTS:
+            rows += [(kind, scope, "", e.get("ts", 0), orjson.dumps(e).decode())
+                     for scope, entries in d[kind].items() for e in entries]
+        else:
+            rows += [(kind, "", e.get("student", ""), e.get("ts", 0), orjson.dumps(e).decode())
+                     for e in d[kind]]
+    if rows:
+        writer.executemany(_EVENT_INSERT_SQL, rows)
+
+_repair_data()
+
+def _capped(parent, key, cap):
+    """parent[key] as a deque(maxlen=cap), converting a stored list once.
+
+    Capped logs (audit, alerts, off-task events, per-student history and
+    pending commands) trim themselves on append instead of re-slicing the
+    whole list every time.
+    """
+    v = parent.get(key)
+    if not isinstance(v, deque) or v.maxlen != cap:
+        v = parent[key] = deque(v or (), maxlen=cap)
+    return v
+
+def log_action(entry, d=None):
+    """Append an audit entry: queued to the audit table (batched by the writer
+    thread, which trims it to the newest _AUDIT_MAX rows) and kept in
+    d["audit"], the in-memory tail of recent entries."""
     try:
-        d = ensure_keys(load_data())
-        log = d.setdefault("audit", [])
         entry = dict(entry or {})
         entry["ts"] = int(time.time())
-        log.append(entry)
-        d["audit"] = log[-500:]
-        save_data(d)
+        _capped(load_data() if d is None else d, "audit", _AUDIT_MAX).append(entry)
+        _STORE.touch()
+        writer.enqueue(_AUDIT_INSERT_SQL, (entry["ts"], orjson.dumps(entry).decode()))
+        writer.enqueue(_AUDIT_TRIM_SQL, (_AUDIT_MAX,))  # same batch: the table keeps only the tail
     except Exception:
         pass
 
+def _event_tail(d, kind, scope=""):
+    if kind in _SCOPED_EVENTS:
+        return _capped(d[kind], scope, _EVENT_CAPS[kind])
+    return _capped(d, kind, _EVENT_CAPS[kind])
+
+def _log_event(d, kind, entry, scope=""):
+    """Append to an event stream: one queued events row plus the in-memory tail;
+    the table is trimmed to the same cap in the same writer batch."""
+    _event_tail(d, kind, scope).append(entry)
+    _STORE.touch()
+    writer.enqueue(_EVENT_INSERT_SQL, (kind, scope, entry.get("student", ""), entry["ts"],
+                                       orjson.dumps(entry).decode()))
+    writer.enqueue(_EVENT_TRIM_SQL, (kind, scope, kind, scope, _EVENT_CAPS[kind]))
+
+def _clear_events(d, kind, student=""):
+    """Drop one student's entries (or all) from a stream; returns how many remain."""
+    tail = _event_tail(d, kind)
+    if student:
+        # Older rows may still be in the table, so the DELETE always runs; the
+        # tail is only rebuilt when it actually holds some of theirs.
+        writer.enqueue("DELETE FROM events WHERE kind=? AND scope='' AND student=?", (kind, student))
+        if not any(e.get("student") == student for e in tail):
+            return len(tail)
+        kept = [e for e in tail if e.get("student") != student]
+    else:
+        writer.enqueue("DELETE FROM events WHERE kind=?", (kind,))
+        kept = ()
+    tail.clear()
+    tail.extend(kept)
+    _STORE.touch()
+    return len(tail)
+
+# Per-student one-shot commands, kept until the student's next /api/policy:
+# an events FIFO per student. Queueing and taking share a lock, so each
+# command's INSERT reaches the writer on the same side of a take's DELETE as
+# the command itself was of the pop: the DELETE removes exactly the rows taken.
+_PENDING_LOCK = threading.Lock()
+
+def _queue_for_student(d, student, cmd):
+    with _PENDING_LOCK:
+        _log_event(d, "pending_per_student", cmd, student)
+
+def _take_for_student(d, student):
+    """Pop a student's queued commands (a list; empty when none)."""
+    with _PENDING_LOCK:
+        cmds = d["pending_per_student"].pop(student, None)
+        if cmds is None:
+            return []
+        writer.enqueue("DELETE FROM events WHERE kind='pending_per_student' AND scope=?", (student,))
+    _STORE.touch()
+    return list(cmds)
+
 
 # =========================
 # Guest handling helper
 # =========================
 _GUEST_TOKENS = ("guest", "anon", "anonymous", "trial", "temp")
+_GUEST_RE = re.compile("|".join(map(re.escape, _GUEST_TOKENS)))
 
+# Every heartbeat asks this for the same few hundred identities; memoize them.
+@lru_cache(maxsize=4096)
 def _is_guest_identity(email: str, name: str) -> bool:
     """Heuristic: treat empty email or names/emails containing guest-like tokens as guest."""
     e = (email or "").strip().lower()
     n = (name or "").strip().lower()
     if not e:
         return True
-    if any(t in e for t in _GUEST_TOKENS):
-        return True
-    if any(t in n for t in _GUEST_TOKENS):
-        return True
-    return False
+    return _GUEST_RE.search(e) is not None or _GUEST_RE.search(n) is not None
 
 
 # =========================
 # Scenes Helpers
 # =========================
+# path -> (stat key, revision, parsed scenes); lets reads skip JSON parsing while the
+# file is unchanged. The cached dict is shared: handlers that mutate it must call
+# _save_scenes(). Derived caches key on _SCENES_REV, which every save (and every
+# re-read of an externally edited file) bumps - mtime alone can miss a fast rewrite.
+_SCENES_CACHE = {}
+_SCENES_REV = 0
+
+def _scenes_stat():
+    try:
+        st = os.stat(SCENES_PATH)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def _load_scenes():
+    global _SCENES_REV
+    stat = _scenes_stat()
+    hit = _SCENES_CACHE.get(SCENES_PATH)
+    if hit and stat is not None and hit[0] == stat:
+        return hit[2]
     try:
         with open(SCENES_PATH, "r", encoding="utf-8") as f:
             obj = json.load(f)
@@ -240,20 +673,58 @@ def _load_scenes():
     obj.setdefault("allowed", [])
     obj.setdefault("blocked", [])
     obj.setdefault("current", None)
+    if stat is not None:
+        _SCENES_REV += 1
+        _SCENES_CACHE[SCENES_PATH] = (stat, _SCENES_REV, obj)
     return obj
 
+# (scenes revision, {str(id): scene}); rebuilt when _save_scenes() writes a new revision.
+_SCENE_INDEX = {}
+
+def _scene_index(store):
+    """Map scene id -> scene across both buckets (first match wins, like the old scans)."""
+    hit = _SCENES_CACHE.get(SCENES_PATH)
+    cached = hit is not None and hit[2] is store
+    if cached and _SCENE_INDEX.get("rev") == hit[1]:
+        return _SCENE_INDEX["by_id"]
+    by_id = {}
+    for bucket in ("allowed", "blocked"):
+        for s in store.get(bucket, []):
+            by_id.setdefault(str(s.get("id")), s)
+    if cached:
+        _SCENE_INDEX.update(rev=hit[1], by_id=by_id)
+    return by_id
+
+def _current_scene(store):
+    """Scene object named by store["current"], or None."""
+    current = store.get("current") or None
+    if not current:
+        return None
+    return _scene_index(store).get(str(current.get("id")))
+
 def _save_scenes(obj):
+    global _SCENES_REV
     obj = obj or {}
     obj.setdefault("allowed", [])
     obj.setdefault("blocked", [])
     obj.setdefault("current", None)
-    with open(SCENES_PATH, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2)
+    # Write a temp file and rename so readers never see a half-written scenes.json
+    tmp = f"{SCENES_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, separators=(",", ":"))
+    os.replace(tmp, SCENES_PATH)
+    _SCENES_REV += 1
+    _SCENES_CACHE[SCENES_PATH] = (_scenes_stat(), _SCENES_REV, obj)
 
 
 # =========================
 # Pages
 # =========================
+@lru_cache(maxsize=None)
+def _static_page(name):
+    """Render a template with no Jinja expressions once; its output never varies."""
+    return render_template(name)
+
 @app.route("/")
 def index():
     u = current_user()
@@ -263,7 +734,7 @@ def index():
 
 @app.route("/login")
 def login_page():
-    return render_template("login.html")
+    return _static_page("login.html")
 
 @app.route("/admin")
 def admin_page():
@@ -277,7 +748,8 @@ def teacher_page():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return redirect(url_for("login_page"))
-    return render_template("teacher.html", data=load_data(), user=u)
+    # teacher.html is static markup (the page fetches everything from /api/*).
+    return _static_page("teacher.html")
 
 @app.route("/logout")
 def logout():
@@ -290,21 +762,77 @@ def logout():
 # Teacher Presentation (WebRTC signaling via REST polling)
 # =========================
 
-from datetime import datetime
-from collections import defaultdict
+@dataclass
+class PresentRoom:
+    """Signaling state for one presentation room."""
+    offers: dict = field(default_factory=dict)    # client_id -> viewer SDP offer
+    answers: dict = field(default_factory=dict)   # client_id -> teacher SDP answer
+    # client_id -> pending ICE candidates; deques are drained in place on poll
+    cand_v: defaultdict = field(default_factory=lambda: defaultdict(deque))
+    cand_t: defaultdict = field(default_factory=lambda: defaultdict(deque))
+    updated: int = field(default_factory=lambda: int(time.time()))
+    active: bool = False
+
+# In-memory session store: {room: PresentRoom}, kept in least-recently-used order
+PRESENT = OrderedDict()
+_PRESENT_LOCK = threading.Lock()
+_PRESENT_MAX_ROOMS = 1024
+_PRESENT_IDLE_SECS = 600
+
+def _present_room(room, create=False):
+    """Look up a room (marking it recently used); only POST paths may create one."""
+    with _PRESENT_LOCK:
+        r = PRESENT.get(room)
+        if r is not None:
+            PRESENT.move_to_end(room)
+        elif create:
+            r = PRESENT[room] = PresentRoom()
+            if len(PRESENT) > _PRESENT_MAX_ROOMS:
+                _evict_present_rooms()
+        return r
+
+def _evict_present_rooms():
+    """Drop inactive rooms idle > 10 min (viewer answer polls count as activity),
+    then LRU inactive rooms while over the cap. Caller holds _PRESENT_LOCK."""
+    cutoff = int(time.time()) - _PRESENT_IDLE_SECS
+    for room, r in list(PRESENT.items()):
+        if not r.active and r.updated < cutoff:
+            del PRESENT[room]
+    for room, r in list(PRESENT.items()):  # oldest first
+        if len(PRESENT) <= _PRESENT_MAX_ROOMS:
+            break
+        if not r.active:
+            del PRESENT[room]
+
+def _sweep_present_rooms():
+    with _PRESENT_LOCK:
+        _evict_present_rooms()
+    t = threading.Timer(60, _sweep_present_rooms)
+    t.daemon = True
+    t.start()
+
+_sweep_present_rooms()
+
+def _unknown_room():
+    return jsonify({"ok": False, "error": "unknown room"}), 404
 
-# In-memory session store: {room: {offers:{client_id: sdp}, answers:{client_id:sdp}, cand_v:{client_id:[cands]}, cand_t:{client_id:[cands]}, updated:int, active:bool}}
-PRESENT = defaultdict(lambda: {"offers": {}, "answers": {}, "cand_v": defaultdict(list), "cand_t": defaultdict(list), "updated": int(time.time()), "active": False})
+# Bytes outside [a-zA-Z0-9_-]; translate() drops them in one C pass (room/client ids).
+_ID_STRIP = bytes(b for b in range(256)
+                  if not (chr(b).isascii() and (chr(b).isalnum() or chr(b) in "_-")))
+
+def _safe_id(s):
+    """Same result as re.sub(r'[^a-zA-Z0-9_-]+', '', s), without the regex engine."""
+    return s.encode("utf-8", "ignore").translate(None, _ID_STRIP).decode("ascii")
 
 def _clean_room(room):
     r = PRESENT.get(room)
     if not r: return
     # drop stale viewers (> 10 minutes inactivity)
     now = int(time.time())
-    for cid in list(r["offers"].keys()):
+    for cid in list(r.offers.keys()):
         # if no answer & offer older than 10 min, drop
         pass
-    r["updated"] = now
+    r.updated = now
 
 @app.route("/teacher/present")
 def teacher_present_page():
@@ -312,7 +840,7 @@ def teacher_present_page():
     if not u:
         return redirect(url_for("login_page"))
     # room id based on teacher email (stable across session)
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', (u.get("email") or "classroom").split("@")[0])
+    room = _safe_id((u.get("email") or "classroom").split("@")[0])
     return render_template(
         "teacher_present.html",
         data=load_data(),
@@ -323,85 +851,98 @@ def teacher_present_page():
 
 @app.route("/present/<room>")
 def student_present_view(room):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
+    room = _safe_id(room)
     return render_template("present.html",  room=room, ice_servers=_ice_servers())
 
 @app.route("/api/present/<room>/start", methods=["POST"])
 def api_present_start(room):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room]["active"] = True
-    PRESENT[room]["updated"] = int(time.time())
+    room = _safe_id(room)
+    r = _present_room(room, create=True)
+    r.active = True
+    r.updated = int(time.time())
     return jsonify({"ok": True, "room": room})
 
 @app.route("/api/present/<room>/end", methods=["POST"])
 def api_present_end(room):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    PRESENT[room] = {"offers": {}, "answers": {}, "cand_v": defaultdict(list), "cand_t": defaultdict(list), "updated": int(time.time()), "active": False}
+    room = _safe_id(room)
+    with _PRESENT_LOCK:
+        PRESENT.pop(room, None)
     return jsonify({"ok": True})
 
 @app.route("/api/present/<room>/status", methods=["GET"])
 def api_present_status(room):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT.get(room) or {}
-    return jsonify({"ok": True, "active": bool(r.get("active"))})
+    room = _safe_id(room)
+    r = _present_room(room)
+    return jsonify({"ok": True, "active": bool(r and r.active)})
 
 # Viewer posts offer and polls for answer
 @app.route("/api/present/<room>/viewer/offer", methods=["POST"])
 def api_present_viewer_offer(room):
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     sdp = body.get("sdp")
     client_id = body.get("client_id") or str(uuid.uuid4())
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT[room]
-    r["offers"][client_id] = sdp
-    r["updated"] = int(time.time())
+    room = _safe_id(room)
+    r = _present_room(room, create=True)
+    r.offers[client_id] = sdp
+    r.updated = int(time.time())
     return jsonify({"ok": True, "client_id": client_id})
 
 @app.route("/api/present/<room>/offers", methods=["GET"])
 def api_present_offers(room):
     # Teacher polls for pending offers
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    offers = PRESENT[room]["offers"]
+    room = _safe_id(room)
+    r = _present_room(room)
+    if r is None:
+        return _unknown_room()
+    offers = r.offers
     return jsonify({"ok": True, "offers": offers})
 
 @app.route("/api/present/<room>/answer/<client_id>", methods=["POST", "GET"])
 def api_present_answer(room, client_id):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    client_id = re.sub(r'[^a-zA-Z0-9_-]+','', client_id)
-    r = PRESENT[room]
+    room = _safe_id(room)
+    client_id = _safe_id(client_id)
+    r = _present_room(room, create=request.method == "POST")
+    if r is None:
+        return _unknown_room()
     if request.method == "POST":
-        body = request.json or {}
+        body = request.get_json(silent=True) or {}
         sdp = body.get("sdp")
-        r["answers"][client_id] = sdp
+        r.answers[client_id] = sdp
         # once answered, remove offer (optional)
-        if client_id in r["offers"]:
-            del r["offers"][client_id]
-        r["updated"] = int(time.time())
+        r.offers.pop(client_id, None)
+        r.updated = int(time.time())
         return jsonify({"ok": True})
     else:
-        ans = r["answers"].get(client_id)
+        # A viewer waiting on its answer keeps the room alive: present.html posts its
+        # offer once and then only polls here, possibly long before the teacher starts.
+        r.updated = int(time.time())
+        ans = r.answers.get(client_id)
         return jsonify({"ok": True, "answer": ans})
 
 # ICE candidates (trickle)
 @app.route("/api/present/<room>/candidate/<side>/<client_id>", methods=["POST", "GET"])
 def api_present_candidate(room, side, client_id):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    client_id = re.sub(r'[^a-zA-Z0-9_-]+','', client_id)
+    room = _safe_id(room)
+    client_id = _safe_id(client_id)
     side = "viewer" if side.lower().startswith("v") else "teacher"
-    r = PRESENT[room]
-    bucket_from = r["cand_v"] if side == "viewer" else r["cand_t"]
-    bucket_to   = r["cand_t"] if side == "viewer" else r["cand_v"]
+    r = _present_room(room, create=request.method == "POST")
+    if r is None:
+        return _unknown_room()
+    bucket_from = r.cand_v if side == "viewer" else r.cand_t
+    bucket_to   = r.cand_t if side == "viewer" else r.cand_v
     if request.method == "POST":
-        body = request.json or {}
+        body = request.get_json(silent=True) or {}
         cands = body.get("candidates") or []
         if cands:
             bucket_from[client_id].extend(cands)
-        r["updated"] = int(time.time())
+        r.updated = int(time.time())
         return jsonify({"ok": True})
     else:
         # GET fetch and clear incoming candidates for this side
-        cands = bucket_to.get(client_id, [])
-        bucket_to[client_id] = []
+        dq = bucket_to.get(client_id)
+        cands = list(dq) if dq else []
+        if dq:
+            dq.clear()
         return jsonify({"ok": True, "candidates": cands})
 
 
@@ -410,13 +951,11 @@ def api_present_candidate(room, side, client_id):
 # =========================
 @app.route("/api/login", methods=["POST"])
 def api_login():
-    body = request.json or request.form
+    body = request.get_json(silent=True) or request.form
     email = (body.get("email") or "").strip().lower()
     pw = body.get("password") or ""
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT email,role FROM users WHERE email=? AND password=?", (email, pw))
-    row = cur.fetchone()
-    con.close()
+    with pool.checkout() as con:
+        row = con.execute("SELECT email,role FROM users WHERE email=? AND password=?", (email, pw)).fetchone()
     if row:
         session["user"] = {"email": row[0], "role": row[1]}
         return jsonify({"ok": True, "role": row[1]})
@@ -426,26 +965,44 @@ def api_login():
 # =========================
 # Core Data & Settings
 # =========================
+# Serialized /api/data body and its ETag, tagged with the settings version it was
+# built from; set_setting() bumps the version, so a snapshot racing a write is
+# never served (or stored) as current.
+_SETTINGS_VERSION = 0
+_DATA_SNAPSHOT = {}
+
+def _api_data_snapshot():
+    global _DATA_SNAPSHOT
+    snap = _DATA_SNAPSHOT
+    version = _SETTINGS_VERSION
+    if snap.get("version") != version:
+        body = orjson.dumps({
+            "settings": {
+                "chat_enabled": bool(get_setting("chat_enabled", True)),
+                "youtube_mode": get_setting("youtube_mode", "normal"),
+            },
+            "lists": {
+                "teacher_blocks": get_setting("teacher_blocks", []),
+                "teacher_allow": get_setting("teacher_allow", []),
+            }
+        })
+        snap = {"version": version, "etag": hashlib.md5(body).hexdigest(), "body": body}
+        if _SETTINGS_VERSION == version:
+            _DATA_SNAPSHOT = snap
+    return snap
+
 @app.route("/api/data")
 def api_data():
-    return jsonify({
-        "settings": {
-            "chat_enabled": bool(get_setting("chat_enabled", True)),
-            "youtube_mode": get_setting("youtube_mode", "normal"),
-        },
-        "lists": {
-            "teacher_blocks": get_setting("teacher_blocks", []),
-            "teacher_allow": get_setting("teacher_allow", []),
-        }
-    })
+    snap = _api_data_snapshot()
+    return _conditional(app.response_class(snap["body"], mimetype="application/json"), snap["etag"])
 
 @app.route("/api/settings", methods=["POST"])
 def api_settings():
     u = current_user()
     if not u or u["role"] != "admin":
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = load_data()
+    b = request.get_json(silent=True) or {}
     if "blocked_redirect" in b:
         d["settings"]["blocked_redirect"] = b["blocked_redirect"]
     if "chat_enabled" in b:
@@ -453,7 +1010,9 @@ def api_settings():
         set_setting("chat_enabled", bool(b["chat_enabled"]))
     if "passcode" in b and b["passcode"]:
         d["settings"]["passcode"] = b["passcode"]
+    _bump_policy()
     save_data(d)
+    settings_cache.invalidate()
     return jsonify({"ok": True, "settings": d["settings"]})
 
 @app.route("/api/categories", methods=["POST"])
@@ -461,15 +1020,17 @@ def api_categories():
     u = current_user()
     if not u or u["role"] != "admin":
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = load_data()
+    b = request.get_json(silent=True) or {}
     name = b.get("name")
     urls = b.get("urls", [])
     bp = b.get("blockPage", "")
     if not name:
         return jsonify({"ok": False, "error": "name required"}), 400
     d["categories"][name] = {"urls": urls, "blockPage": bp}
+    _bump_policy()
     save_data(d)
+    settings_cache.invalidate()
     return jsonify({"ok": True})
 
 @app.route("/api/categories/delete", methods=["POST"])
@@ -477,10 +1038,11 @@ def api_categories_delete():
     u = current_user()
     if not u or u["role"] != "admin":
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    name = (request.json or {}).get("name")
+    d = load_data()
+    name = (request.get_json(silent=True) or {}).get("name")
     if name in d["categories"]:
         del d["categories"][name]
+        _bump_policy()
         save_data(d)
     return jsonify({"ok": True})
 
@@ -493,21 +1055,22 @@ def api_announce():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    d["announcements"] = (request.json or {}).get("message", "")
+    d = load_data()
+    d["announcements"] = (request.get_json(silent=True) or {}).get("message", "")
+    _bump_policy()
+    log_action({"event": "announce"}, d)
     save_data(d)
-    log_action({"event": "announce"})
     return jsonify({"ok": True})
 
 @app.route("/api/class/set", methods=["GET", "POST"])
 def api_class_set():
-    d = ensure_keys(load_data())
+    d = load_data()
 
     if request.method == "GET":
         cls = d["classes"].get("period1", {})
         return jsonify({"class": cls, "settings": d["settings"]})
 
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     cls = d["classes"].get("period1", {})
     prev_active = bool(cls.get("active", True))
 
@@ -533,16 +1096,18 @@ def api_class_set():
         d["settings"]["passcode"] = body["passcode"]
 
     d["classes"]["period1"] = cls
+    _bump_class_lists()
+    _bump_policy()
 
     if bool(cls.get("active", True)) and not prev_active:
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        d["pending_commands"].setdefault("*", []).append({
             "type": "notify",
             "title": "Class session is active",
             "message": "Please join and stay until dismissed."
         })
 
+    log_action({"event": "class_set", "active": cls.get("active", True)}, d)
     save_data(d)
-    log_action({"event": "class_set", "active": cls.get("active", True)})
     return jsonify({"ok": True, "class": cls, "settings": d["settings"]})
 
 @app.route("/api/class/toggle", methods=["POST"])
@@ -551,16 +1116,17 @@ def api_class_toggle():
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = load_data()
+    b = request.get_json(silent=True) or {}
     cid = b.get("class_id", "period1")
     key = b.get("key")
     val = bool(b.get("value"))
 
     if cid in d["classes"] and key in ("focus_mode", "paused"):
         d["classes"][cid][key] = val
+        _bump_policy()
+        log_action({"event": "class_toggle", "key": key, "value": val}, d)
         save_data(d)
-        log_action({"event": "class_toggle", "key": key, "value": val})
         return jsonify({"ok": True, "class": d["classes"][cid]})
 
     return jsonify({"ok": False, "error": "invalid"}), 400
@@ -574,26 +1140,29 @@ def api_command():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = load_data()
+    b = request.get_json(silent=True) or {}
     target = b.get("student") or "*"
     cmd = b.get("command")
     if not cmd or "type" not in cmd:
         return jsonify({"ok": False, "error": "invalid"}), 400
-    d.setdefault("pending_commands", {}).setdefault(target, []).append(cmd)
+    d["pending_commands"].setdefault(target, []).append(cmd)
+    log_action({"event": "command", "target": target, "type": cmd.get("type")}, d)
     save_data(d)
-    log_action({"event": "command", "target": target, "type": cmd.get("type")})
     return jsonify({"ok": True})
 
 @app.route("/api/commands/<student>", methods=["GET", "POST"])
 def api_commands(student):
-    d = ensure_keys(load_data())
+    d = load_data()
 
     if request.method == "GET":
-        cmds = d["pending_commands"].get(student, []) + d["pending_commands"].get("*", [])
-        d["pending_commands"][student] = []
-        d["pending_commands"]["*"] = []
-        save_data(d)
+        pc = d["pending_commands"]
+        cmds = pc.get(student, []) + pc.get("*", [])
+        # Most polls find nothing queued; only touch (and persist) the store when they don't.
+        if cmds:
+            pc[student] = []
+            pc["*"] = []
+            save_data(d)
         return jsonify({"commands": cmds})
 
     # POST (push from teacher)
@@ -601,90 +1170,229 @@ def api_commands(student):
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     if not b.get("type"):
         return jsonify({"ok": False, "error": "missing type"}), 400
 
     d["pending_commands"].setdefault(student, []).append(b)
+    log_action({"event": "command_sent", "to": student, "cmd": b.get("type")}, d)
     save_data(d)
-    log_action({"event": "command_sent", "to": student, "cmd": b.get("type")})
     return jsonify({"ok": True})
 
 
 # =========================
 # Off-task Check (simple)
 # =========================
+_ALLOW_PATTERN_RE = re.compile(r"\*://\*\.(.+?)/\*")
+
+# Optional live feed: with SOCKETIO_MQ set (e.g. redis://...), off-task events are
+# emitted to the Socket.IO server on that message queue. Built once; None disables.
+_socketio = None
+if os.environ.get("SOCKETIO_MQ"):
+    try:
+        from flask_socketio import SocketIO  # type: ignore
+        _socketio = SocketIO(message_queue=os.environ["SOCKETIO_MQ"])
+    except Exception as _e:
+        print("[WARN] Socket.IO emitter unavailable:", _e)
+
+# Known game/streaming sites; any hit in the URL marks the visit off-task.
+_OFFTASK_KEYWORDS_RE = re.compile("coolmath|roblox|twitch|steam|epicgames")
+
+@lru_cache(maxsize=16)
+def _allowed_host_re(patterns):
+    """One "(?:dom1|dom2)$" suffix matcher for "*://*.example.com/*" allowlist
+    patterns, or None when none apply; cached per allowlist tuple."""
+    domains = set()
+    for patt in patterns:
+        m = _ALLOW_PATTERN_RE.match(patt)
+        if m:
+            domains.add(m.group(1).lower())
+    if not domains:
+        return None
+    return re.compile(r"(?:%s)\Z" % "|".join(map(re.escape, sorted(domains))))
+
+def _url_host(url):
+    """Lowercased hostname of an absolute URL. Plain scheme://host[:port]/... is
+    sliced with a few str.find calls; anything odd (userinfo, IPv6) goes to urlparse."""
+    i = url.find("://")
+    if i > 0 and url[:i].isalpha():
+        start = i + 3
+        end = len(url)
+        for ch in "/?#":
+            j = url.find(ch, start, end)
+            if j != -1:
+                end = j
+        netloc = url[start:end]
+        if "@" not in netloc and "[" not in netloc:
+            return netloc.partition(":")[0].lower()
+    try:
+        return urlparse(url).hostname or ""
+    except Exception:
+        return ""
+
 @app.route("/api/offtask/check", methods=["POST"])
 def api_offtask_check():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     url = (b.get("url") or "")
     if not student or not url:
         return jsonify({"ok": False}), 400
 
-    d = ensure_keys(load_data())
+    d = load_data()
     # allowlist from policy (scene) if any
-    scene_allowed = set()
-    for patt in (d.get("policy", {}).get("allowlist") or []):
-        m = re.match(r"\*\:\/\/\*\.(.+?)\/\*", patt)
-        if m:
-            scene_allowed.add(m.group(1).lower())
+    allowed_re = _allowed_host_re(tuple(d.get("policy", {}).get("allowlist") or ()))
 
-    host = ""
-    try:
-        host = urlparse(url).hostname or ""
-    except Exception:
-        pass
+    host = _url_host(url)
 
-    on_task = any(host.endswith(dom) for dom in scene_allowed) if host else False
-    bad_kw = ("coolmath", "roblox", "twitch", "steam", "epicgames")
-    if any(k in url.lower() for k in bad_kw):
+    on_task = bool(host and allowed_re and allowed_re.search(host))
+    if _OFFTASK_KEYWORDS_RE.search(url.lower()):
         on_task = False
 
-    v = {"student": student, "url": url, "ts": int(time.time()), "on_task": bool(on_task)}
-    d.setdefault("offtask_events", []).append(v)
-    d["offtask_events"] = d["offtask_events"][-2000:]
+    v = {"student": student, "url": url, "ts": g.now, "on_task": bool(on_task)}
+    _capped(d, "offtask_events", 2000).append(v)
     save_data(d)
 
-    try:
-        # If using socketio, you could emit here; safely ignore if not present
-        from flask_socketio import SocketIO  # type: ignore
-        socketio = SocketIO(message_queue=None)
-        socketio.emit("offtask", v, broadcast=True)
-    except Exception:
-        pass
+    if _socketio is not None:
+        try:
+            _socketio.emit("offtask", v)
+        except Exception as e:
+            print("[WARN] offtask emit failed:", e)
 
     return jsonify({"ok": True, "on_task": bool(on_task)})
 
 
+# =========================
+# Screenshot blobs
+# =========================
+# Screenshot history keeps a content hash instead of the base64 data URL; the
+# image lives once under screenshots/<ab>/<hash>.<ext> and is served with a
+# far-future cache header (its name never changes meaning).
+_SHOT_EXT = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+_SHOT_NAME_RE = re.compile(r"[0-9a-f]{32}\.(?:png|jpg|webp)")
+
+def _store_shot(data_url):
+    """Write a data: URL image to the blob dir; returns its blob name, or None if not an image data URL."""
+    head, sep, payload = (data_url or "").partition(",")
+    if not sep or not head.startswith("data:") or not head.endswith(";base64"):
+        return None
+    ext = _SHOT_EXT.get(head[5:-7])
+    if not ext:
+        return None
+    try:
+        raw = base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    name = hashlib.sha256(raw).hexdigest()[:32] + ext
+    path = os.path.join(SHOTS_DIR, name[:2], name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+    return name
+
+_SHOT_LOCK = threading.Lock()
+_SHOT_REFS = None  # blob name -> history entries referencing it; built on first use
+
+def _append_shot(d, hist, entry):
+    """Append to a student's capped shot history; a blob whose last referencing
+    entry was just evicted is deleted from disk. Call with _SHOT_LOCK held."""
+    global _SHOT_REFS
+    if _SHOT_REFS is None:
+        _SHOT_REFS = {}
+        for arr in d["screenshots"].values():
+            for e in arr:
+                if e.get("blob"):
+                    _SHOT_REFS[e["blob"]] = _SHOT_REFS.get(e["blob"], 0) + 1
+    old = hist[0].get("blob") if len(hist) == hist.maxlen else None
+    hist.append(entry)
+    if entry.get("blob"):
+        _SHOT_REFS[entry["blob"]] = _SHOT_REFS.get(entry["blob"], 0) + 1
+    if old:
+        n = _SHOT_REFS.get(old, 1) - 1
+        if n > 0:
+            _SHOT_REFS[old] = n
+            return
+        _SHOT_REFS.pop(old, None)
+        try:
+            os.remove(os.path.join(SHOTS_DIR, old[:2], old))
+        except OSError:
+            pass
+
+def _shot_view(e):
+    """History entry as the teacher UI expects it (dataUrl is a URL for blob-backed shots)."""
+    if "blob" in e:
+        e["dataUrl"] = "/screenshots/" + e.pop("blob")
+    return e
+
+@app.route("/screenshots/<name>")
+def screenshot_blob(name):
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    if not _SHOT_NAME_RE.fullmatch(name):
+        return jsonify({"ok": False, "error": "not found"}), 404
+    resp = send_from_directory(os.path.join(SHOTS_DIR, name[:2]), name, max_age=31536000)
+    resp.cache_control.immutable = True
+    resp.cache_control.private = True
+    return resp
+
+
 # =========================
 # Presence / Heartbeat
 # =========================
+# student -> (hash of last fully processed heartbeat body, when), oldest first;
+# entries past the dedupe window are dropped as new ones arrive.
+_LAST_HB = OrderedDict()
+_LAST_HB_LOCK = threading.Lock()
+_HB_DEDUPE_SECS = 5
+
+def _remember_hb(student, sig, now):
+    with _LAST_HB_LOCK:
+        _LAST_HB[student] = (sig, now)
+        _LAST_HB.move_to_end(student)
+        cutoff = now - _HB_DEDUPE_SECS
+        while _LAST_HB:
+            oldest = next(iter(_LAST_HB.values()))
+            if oldest[1] > cutoff:
+                break
+            _LAST_HB.popitem(last=False)
+
 @app.route("/api/heartbeat", methods=["POST"])
 def api_heartbeat():
     """Student heartbeat – updates presence, logs timeline, screenshots, and returns extension state."""
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     display_name = b.get("student_name", "")
 
     # Global kill switch (safe if file type changed)
-    data_global = ensure_keys(load_data())
-    extension_enabled_global = bool(data_global.get("extension_enabled", True))
+    d = load_data()
+    extension_enabled_global = bool(d.get("extension_enabled", True))
 
     # Hard-disable guest/anonymous identities – do NOT log or persist anything
     if _is_guest_identity(student, display_name):
         return jsonify({
             "ok": True,
-            "server_time": int(time.time()),
+            "server_time": g.now,
             "extension_enabled": False  # completely disabled for guests
         })
 
-    d = ensure_keys(load_data())
-    d.setdefault("presence", {})
+    # Same body as this student's last full heartbeat, within the window: only
+    # bump last_seen in memory. The window is not extended, so a full pass (and
+    # the 15s timeline tick) still runs at least every _HB_DEDUPE_SECS.
+    now = g.now
+    sig = hash(request.get_data())
+    last = _LAST_HB.get(student)
+    pres = d["presence"].get(student)
+    if last and last[0] == sig and now - last[1] < _HB_DEDUPE_SECS and pres is not None:
+        pres["last_seen"] = now
+        return jsonify({"ok": True, "server_time": now, "extension_enabled": bool(extension_enabled_global)})
+    _remember_hb(student, sig, now)
 
     if student:
         pres = d["presence"].setdefault(student, {})
-        pres["last_seen"] = int(time.time())
+        pres["last_seen"] = now
         pres["student_name"] = display_name
         pres["tab"] = b.get("tab", {}) or {}
         pres["tabs"] = b.get("tabs", []) or []
@@ -697,20 +1405,20 @@ def api_heartbeat():
         pres["screenshot"] = b.get("screenshot", "") or ""
 
         # --- Keep only screenshots for open tabs shown in modal preview ---
-        shots = pres.get("tabshots", {})
-        for k, v in (b.get("tabshots", {}) or {}).items():
-            shots[str(k)] = v
         open_ids = {str(t.get("id")) for t in pres["tabs"] if "id" in t}
-        for k in list(shots.keys()):
-            if k not in open_ids:
-                del shots[k]
+        old = pres.get("tabshots", {})
+        shots = {k: old[k] for k in open_ids if k in old}
+        # Closed tabs' incoming shots never enter the dict.
+        for k, v in (b.get("tabshots", {}) or {}).items():
+            k = str(k)
+            if k in open_ids:
+                shots[k] = v
         pres["tabshots"] = shots
         d["presence"][student] = pres
 
         # ---------- Timeline & Screenshot history ----------
         try:
-            timeline = d.setdefault("history", {}).setdefault(student, [])
-            now = int(time.time())
+            timeline = _capped(d["history"], student, 500)
             cur = pres.get("tab", {}) or {}
             url = (cur.get("url") or "").strip()
             title = (cur.get("title") or "").strip()
@@ -727,29 +1435,31 @@ def api_heartbeat():
 
             if should_add:
                 timeline.append({"ts": now, "title": title, "url": url, "favIconUrl": fav})
-                d["history"][student] = timeline[-500:]  # cap
 
             # Screenshot history: if extension passes `shot_log: [{tabId,dataUrl,title,url}]`
             shot_log = b.get("shot_log") or []
             if shot_log:
-                hist = d.setdefault("screenshots", {}).setdefault(student, [])
+                hist = _capped(d["screenshots"], student, 200)
                 for s in shot_log[:10]:
-                    hist.append({
-                        "ts": now,
-                        "tabId": s.get("tabId"),
-                        "dataUrl": s.get("dataUrl"),
-                        "title": (s.get("title") or ""),
-                        "url": (s.get("url") or "")
-                    })
-                d["screenshots"][student] = hist[-200:]
+                    entry = {"ts": now, "tabId": s.get("tabId")}
+                    # Store + ref under one lock so an eviction can't unlink a blob mid-reuse
+                    with _SHOT_LOCK:
+                        blob = _store_shot(s.get("dataUrl"))
+                        if blob:
+                            entry["blob"] = blob
+                        else:
+                            entry["dataUrl"] = s.get("dataUrl")
+                        entry["title"] = s.get("title") or ""
+                        entry["url"] = s.get("url") or ""
+                        _append_shot(d, hist, entry)
         except Exception as e:
             print("[WARN] Heartbeat logging error:", e)
 
-    save_data(d)
+    save_data(d, (f"presence/{student}", f"history/{student}", f"screenshots/{student}") if student else ())
 
     return jsonify({
         "ok": True,
-        "server_time": int(time.time()),
+        "server_time": g.now,
         # Honor global kill switch but also keep guest lockout enforced above.
         "extension_enabled": bool(extension_enabled_global)
     })
@@ -759,7 +1469,7 @@ def api_presence():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    return jsonify(load_data().get("presence", {}))
+    return _stream_dict(load_data().get("presence", {}))
 
 
 # =========================
@@ -772,26 +1482,66 @@ def api_extension_toggle():
     if not user or user.get("role") not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     enabled = bool(body.get("enabled", True))
 
-    data = ensure_keys(load_data())
+    data = load_data()
     data["extension_enabled"] = enabled
+    log_action({"event": "extension_toggle", "enabled": enabled, "by": user.get("email")}, data)
     save_data(data)
 
     print(f"[INFO] Extension toggle → {'ENABLED' if enabled else 'DISABLED'} by {user.get('email')}")
-    log_action({"event": "extension_toggle", "enabled": enabled, "by": user.get("email")})
     return jsonify({"ok": True, "extension_enabled": enabled})
 
 
 # =========================
 # Policy
 # =========================
+# Bumped when period1's lists change; with the scenes.json revision it keys the memo below.
+_CLASS_LISTS_VERSION = 0
+
+def _bump_class_lists():
+    global _CLASS_LISTS_VERSION
+    _CLASS_LISTS_VERSION += 1
+
+# Bumped by every handler that edits what /api/policy reads from the store
+# (settings, categories, announcement, class flags); keys _POLICY_CACHE.
+_POLICY_VERSION = 0
+_POLICY_CACHE = {}
+
+def _bump_policy():
+    global _POLICY_VERSION
+    _POLICY_VERSION += 1
+
+@lru_cache(maxsize=8)
+def _class_scene_lists(version, scenes_rev):
+    """(allowlist, teacher_blocks, scene_forces_focus, current) for period1 merged with
+    the current scene. The same for every student, so polls share one result; the
+    arguments only key the cache."""
+    cls = load_data()["classes"]["period1"]
+    store = _load_scenes()
+    scene_obj = _current_scene(store)
+
+    # Start with class-level lists
+    allowlist = tuple(cls.get("allowlist", []))
+    teacher_blocks = tuple(cls.get("teacher_blocks", []))
+    focus = False
+
+    if scene_obj:
+        if scene_obj.get("type") == "allowed":
+            # allow-only mode (focus true)
+            allowlist = tuple(scene_obj.get("allow", []))
+            focus = True
+        elif scene_obj.get("type") == "blocked":
+            # add extra teacher block patterns
+            teacher_blocks = teacher_blocks + tuple(scene_obj.get("block", []))
+    return allowlist, teacher_blocks, focus, store.get("current") or None
+
 @app.route("/api/policy", methods=["POST"])
 def api_policy():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
+    d = load_data()
     cls = d["classes"]["period1"]
 
     # Base flags
@@ -804,39 +1554,46 @@ def api_policy():
     paused = bool(ov.get("paused", paused))
 
     # deliver any per-student pending commands (one-shot)
-    pending = d.get("pending_per_student", {}).get(student, []) if student else []
-    if student and student in d.get("pending_per_student", {}):
-        d["pending_per_student"].pop(student, None)
-        save_data(d)
+    pending = _take_for_student(d, student) if student else []
 
     # Scene merge logic (no over-blocking)
-    store = _load_scenes()
-    current = store.get("current") or None
-
-    # Start with class-level lists
-    allowlist = list(cls.get("allowlist", []))
-    teacher_blocks = list(cls.get("teacher_blocks", []))
-
-    if current:
-        scene_obj = None
-        for bucket in ("allowed", "blocked"):
-            for s in store.get(bucket, []):
-                if str(s.get("id")) == str(current.get("id")):
-                    scene_obj = s
-                    break
-            if scene_obj:
-                break
-
-        if scene_obj:
-            if scene_obj.get("type") == "allowed":
-                # allow-only mode (focus true)
-                allowlist = list(scene_obj.get("allow", []))
-                focus = True
-            elif scene_obj.get("type") == "blocked":
-                # add extra teacher block patterns
-                teacher_blocks = (teacher_blocks or []) + list(scene_obj.get("block", []))
+    _load_scenes()
+    scenes_rev = _SCENES_REV
+    allowlist, teacher_blocks, scene_focus, current = _class_scene_lists(_CLASS_LISTS_VERSION, scenes_rev)
+    focus = focus or scene_focus
+
+    if pending:
+        # One-shot commands always go out in full.
+        resp = _policy_resp(d, cls, focus, paused, allowlist, teacher_blocks, current, pending)
+        etag = hashlib.blake2b(orjson.dumps(resp, option=orjson.OPT_NON_STR_KEYS), digest_size=12).hexdigest()
+        resp["ts"] = g.now
+        out = app.response_class(orjson.dumps(resp, option=orjson.OPT_NON_STR_KEYS), mimetype="application/json")
+        out.set_etag(etag)
+        return out
+
+    # Without pending commands the body only depends on these inputs, so it is
+    # encoded (and hashed) once per combination and shared by every student.
+    key = (_POLICY_VERSION, _CLASS_LISTS_VERSION, scenes_rev, bool(focus), bool(paused))
+    hit = _POLICY_CACHE.get(key)
+    if hit is None:
+        body = orjson.dumps(_policy_resp(d, cls, focus, paused, allowlist, teacher_blocks, current, []),
+                           option=orjson.OPT_NON_STR_KEYS)
+        hit = (hashlib.blake2b(body, digest_size=12).hexdigest(), body)
+        if len(_POLICY_CACHE) >= 64:
+            _POLICY_CACHE.clear()
+        _POLICY_CACHE[key] = hit
+    etag, body = hit
+    # ETag over everything but the timestamp. A poller that echoes it back in
+    # If-None-Match gets an empty 304 while nothing changed.
+    if etag in request.if_none_match:
+        out = app.response_class(status=304)
+    else:
+        out = app.response_class(body[:-1] + b',"ts":%d}' % g.now, mimetype="application/json")
+    out.set_etag(etag)
+    return out
 
-    resp = {
+def _policy_resp(d, cls, focus, paused, allowlist, teacher_blocks, current, pending):
+    return {
         "blocked_redirect": d.get("settings", {}).get("blocked_redirect", "https://blocked.gdistrict.org/Gschool%20block"),
         "categories": d.get("categories", {}),
         "focus_mode": bool(focus),
@@ -851,21 +1608,31 @@ def api_policy():
         "teacher_blocks": teacher_blocks,
         "chat_enabled": d.get("settings", {}).get("chat_enabled", False),
         "pending": pending,
-        "ts": int(time.time()),
         "scenes": {"current": current}
     }
-    return jsonify(resp)
 
 
 # =========================
 # Timeline & Screenshots
 # =========================
+def _ts_of(pair):
+    return pair[0].get("ts", 0)
+
+def _tail_desc(buckets, limit, since=0):
+    """Same items as merging every student's entries, sorting by ts descending
+    and keeping the last `limit` - but via a bounded heap, copying only the
+    entries returned."""
+    pairs = ((e, s) for s, arr in buckets for e in arr if e.get("ts", 0) >= since)
+    picked = heapq.nsmallest(limit, pairs, key=_ts_of)
+    picked.reverse()
+    return [dict(e, student=s) for e, s in picked]
+
 @app.route("/api/timeline", methods=["GET"])
 def api_timeline():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
+    d = load_data()
     student = (request.args.get("student") or "").strip()
     limit = max(1, min(int(request.args.get("limit", 200)), 1000))
     since = int(request.args.get("since", 0))
@@ -874,34 +1641,25 @@ def api_timeline():
         out = [e for e in d.get("history", {}).get(student, []) if e.get("ts", 0) >= since]
         out.sort(key=lambda x: x.get("ts", 0))
     else:
-        for s, arr in (d.get("history", {}) or {}).items():
-            for e in arr:
-                if e.get("ts", 0) >= since:
-                    out.append(dict(e, student=s))
-        out.sort(key=lambda x: x.get("ts", 0), reverse=True)
-    return jsonify({"ok": True, "items": out[-limit:]})
+        out = _tail_desc((d.get("history", {}) or {}).items(), limit, since)
+    return _stream_items(out[-limit:])
 
 @app.route("/api/screenshots", methods=["GET"])
 def api_screenshots():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
+    d = load_data()
     student = (request.args.get("student") or "").strip()
     limit = max(1, min(int(request.args.get("limit", 100)), 500))
     items = []
 
     if student:
-        items = list(d.get("screenshots", {}).get(student, []))
-        for it in items:
-            it.setdefault("student", student)
+        items = [_shot_view({"student": student, **e}) for e in d.get("screenshots", {}).get(student, [])]
     else:
-        for s, arr in (d.get("screenshots", {}) or {}).items():
-            for e in arr:
-                items.append(dict(e, student=s))
-        items.sort(key=lambda x: x.get("ts", 0), reverse=True)
+        items = [_shot_view(e) for e in _tail_desc((d.get("screenshots", {}) or {}).items(), limit)]
 
-    return jsonify({"ok": True, "items": items[-limit:]})
+    return _stream_items(items[-limit:])
 
 
 # =========================
@@ -909,15 +1667,15 @@ def api_screenshots():
 # =========================
 @app.route("/api/alerts", methods=["GET", "POST"])
 def api_alerts():
-    d = ensure_keys(load_data())
+    d = load_data()
     if request.method == "POST":
-        b = request.json or {}
+        b = request.get_json(silent=True) or {}
         u = current_user()
         student = (b.get("student") or (u["email"] if (u and u.get("role") == "student") else "")).strip()
         if not student:
             return jsonify({"ok": False, "error": "student required"}), 400
         item = {
-            "ts": int(time.time()),
+            "ts": g.now,
             "student": student,
             "kind": b.get("kind", "off_task"),
             "score": float(b.get("score") or 0.0),
@@ -925,16 +1683,15 @@ def api_alerts():
             "url": (b.get("url") or ""),
             "note": (b.get("note") or "")
         }
-        d.setdefault("alerts", []).append(item)
-        d["alerts"] = d["alerts"][-500:]
+        _capped(d, "alerts", 500).append(item)
+        log_action({"event": "alert", "student": student, "kind": item["kind"], "score": item["score"]}, d)
         save_data(d)
-        log_action({"event": "alert", "student": student, "kind": item["kind"], "score": item["score"]})
         return jsonify({"ok": True})
 
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    return jsonify({"ok": True, "items": d.get("alerts", [])[-200:]})
+    return _ojsonify({"ok": True, "items": list(d.get("alerts", ()))[-200:]})
 
 
 @app.route("/api/alerts/clear", methods=["POST"])
@@ -942,13 +1699,18 @@ def api_alerts_clear():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
+    d = load_data()
+    alerts = _capped(d, "alerts", 500)
     if student:
-        d["alerts"] = [a for a in d.get("alerts", []) if a.get("student") != student]
+        kept = [a for a in alerts if a.get("student") != student]
+        if len(kept) == len(alerts):
+            return jsonify({"ok": True})  # nothing of theirs to clear
     else:
-        d["alerts"] = []
+        kept = ()
+    alerts.clear()
+    alerts.extend(kept)
     save_data(d)
     return jsonify({"ok": True})
 
@@ -962,7 +1724,7 @@ def api_scenes_list():
 
 @app.route("/api/scenes", methods=["POST"])
 def api_scenes_create():
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     name = body.get("name")
     s_type = body.get("type")  # "allowed" or "blocked"
     if not name or s_type not in ("allowed", "blocked"):
@@ -985,17 +1747,12 @@ def api_scenes_create():
 
 @app.route("/api/scenes/<sid>", methods=["PUT"])
 def api_scenes_update(sid):
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     scenes = _load_scenes()
-    updated = None
-    for bucket in ("allowed", "blocked"):
-        for s in scenes.get(bucket, []):
-            if s.get("id") == sid:
-                s.update(body)
-                updated = s
-                break
+    updated = _scene_index(scenes).get(sid)
     if not updated:
         return jsonify({"ok": False, "error": "not found"}), 404
+    updated.update(body)
     _save_scenes(scenes)
     log_action({"event": "scene_update", "id": sid})
     return jsonify({"ok": True, "scene": updated})
@@ -1003,9 +1760,15 @@ def api_scenes_update(sid):
 @app.route("/api/scenes/<sid>", methods=["DELETE"])
 def api_scenes_delete(sid):
     scenes = _load_scenes()
-    for bucket in ("allowed", "blocked"):
-        scenes[bucket] = [s for s in scenes.get(bucket, []) if s.get("id") != sid]
-    if scenes.get("current", {}).get("id") == sid:
+    # The id index says whether the scene exists at all; only then touch the
+    # buckets, deleting matches in place rather than copying each list.
+    if sid in _scene_index(scenes):
+        for bucket in ("allowed", "blocked"):
+            lst = scenes.get(bucket, [])
+            for i in range(len(lst) - 1, -1, -1):
+                if str(lst[i].get("id")) == sid:
+                    del lst[i]
+    if (scenes.get("current") or {}).get("id") == sid:
         scenes["current"] = None
     _save_scenes(scenes)
     log_action({"event": "scene_delete", "id": sid})
@@ -1019,10 +1782,9 @@ def api_scenes_export():
     store = _load_scenes()
     scene_id = request.args.get("id")
     if scene_id:
-        for bucket in ("allowed", "blocked"):
-            for s in store.get(bucket, []):
-                if s.get("id") == scene_id:
-                    return jsonify({"ok": True, "scene": s})
+        s = _scene_index(store).get(scene_id)
+        if s:
+            return jsonify({"ok": True, "scene": s})
         return jsonify({"ok": False, "error": "not found"}), 404
     return jsonify({"ok": True, "scenes": store})
 
@@ -1031,7 +1793,7 @@ def api_scenes_import():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     store = _load_scenes()
     if "scene" in body:
         sc = dict(body["scene"])
@@ -1054,7 +1816,7 @@ def api_scenes_apply():
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     sid = body.get("id") or body.get("scene_id")
     disable = bool(body.get("disable", False))
 
@@ -1069,25 +1831,19 @@ def api_scenes_apply():
     if not sid:
         return jsonify({"ok": False, "error": "scene_id required"}), 400
 
-    found = None
-    for bucket in ("allowed", "blocked"):
-        for s in store.get(bucket, []):
-            if str(s.get("id")) == str(sid):
-                found = {"id": s["id"], "name": s.get("name"), "type": s.get("type")}
-                break
-        if found:
-            break
+    s = _scene_index(store).get(str(sid))
+    found = {"id": s["id"], "name": s.get("name"), "type": s.get("type")} if s else None
 
     if not found:
         return jsonify({"ok": False, "error": "scene not found"}), 404
 
     store["current"] = found
     _save_scenes(store)
-    log_action({"event": "scene_applied", "scene": found})
 
     # Push a refresh command to all students
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "policy_refresh"})
+    d = load_data()
+    d["pending_commands"].setdefault("*", []).append({"type": "policy_refresh"})
+    log_action({"event": "scene_applied", "scene": found}, d)
     save_data(d)
     return jsonify({"ok": True, "current": found})
 
@@ -1103,9 +1859,92 @@ def api_scenes_clear():
 # =========================
 # Direct Messages
 # =========================
+# room -> [messages, filled_at, encoded]: DM threads served from memory between sends.
+# Sends append once committed; the TTL bounds staleness from other writers
+# (e.g. the AI chat blueprint can post to any room).
+_DM_CACHE = OrderedDict()
+_DM_VERSION = {}  # room -> committed sends; a fill that raced one is not stored
+_DM_LOCK = threading.Lock()
+_DM_CACHE_ROOMS = 512
+_DM_CACHE_MAX = 1000
+_DM_CACHE_TTL = 30
+_DM_SEND_TIMEOUT = 5  # seconds a send waits for its commit
+
+# Threads are ordered and paged by id: ts only has whole seconds, and ids follow
+# commit order, which is also the order _dm_committed() appends in.
+_DM_THREAD_SQL = "SELECT id,user_id,role,text,ts FROM chat_messages WHERE room=? ORDER BY id"
+_DM_AFTER_SQL = "SELECT id,user_id,role,text,ts FROM chat_messages WHERE room=? AND id>? ORDER BY id"
+
+def _dm_rows(rows):
+    return [{"id": r[0], "from": r[2], "user": r[1], "text": r[3], "ts": r[4]} for r in rows]
+
+def _dm_thread(room, after_id=0):
+    """Messages in a DM room with id > `after_id`, oldest first (a fresh list)."""
+    now = time.monotonic()
+    with _DM_LOCK:
+        hit = _DM_CACHE.get(room)
+        if hit and now - hit[1] < _DM_CACHE_TTL:
+            _DM_CACHE.move_to_end(room)
+            msgs = hit[0]
+            return [m for m in msgs if m["id"] > after_id] if after_id else list(msgs)
+        ver = _DM_VERSION.get(room, 0)
+    if after_id:
+        # Partial thread: served straight from the (room, id) index, not cached.
+        with pool.checkout() as con:
+            return _dm_rows(con.execute(_DM_AFTER_SQL, (room, after_id)).fetchall())
+    with pool.checkout() as con:
+        msgs = _dm_rows(con.execute(_DM_THREAD_SQL, (room,)).fetchall())
+    with _DM_LOCK:
+        if _DM_VERSION.get(room, 0) == ver and len(msgs) <= _DM_CACHE_MAX:
+            _DM_CACHE[room] = [list(msgs), now, None]
+            _DM_CACHE.move_to_end(room)
+            while len(_DM_CACHE) > _DM_CACHE_ROOMS:
+                _DM_CACHE.popitem(last=False)
+    return msgs
+
+def _dm_thread_json(room):
+    """_dm_thread(room) as JSON bytes, encoded once per cached thread version."""
+    with _DM_LOCK:
+        hit = _DM_CACHE.get(room)
+        if hit and hit[2] is not None and time.monotonic() - hit[1] < _DM_CACHE_TTL:
+            _DM_CACHE.move_to_end(room)
+            return hit[2]
+    msgs = _dm_thread(room)
+    body = orjson.dumps(msgs)
+    with _DM_LOCK:
+        hit = _DM_CACHE.get(room)
+        if hit and len(hit[0]) == len(msgs):  # no send landed while encoding
+            hit[2] = body
+    return body
+
+def _dm_committed(room, msg):
+    """Add a committed DM to its cached thread, kept in id order; a message a
+    racing fill already read from the table is not added twice."""
+    with _DM_LOCK:
+        _DM_VERSION[room] = _DM_VERSION.get(room, 0) + 1
+        hit = _DM_CACHE.get(room)
+        if hit:
+            msgs = hit[0]
+            if len(msgs) >= _DM_CACHE_MAX:
+                del _DM_CACHE[room]
+            elif not msgs or msgs[-1]["id"] < msg["id"]:
+                msgs.append(msg)
+                hit[2] = None
+            elif all(m["id"] != msg["id"] for m in msgs):
+                msgs.append(msg)
+                msgs.sort(key=lambda m: m["id"])
+                hit[2] = None
+
+# role -> (room, role, user_id) for a DM send; room is None when the
+# teacher didn't name a student. Roles not listed here may not send.
+_DM_SENDERS = {
+    "student": lambda u, body: (f"dm:{u['email']}", "student", u["email"]),
+    "teacher": lambda u, body: (f"dm:{body['student']}" if body.get("student") else None, "teacher", u["email"]),
+}
+
 @app.route("/api/dm/send", methods=["POST"])
 def api_dm_send():
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     u = current_user()
 
     if not u:
@@ -1119,23 +1958,28 @@ def api_dm_send():
     if not text:
         return jsonify({"ok": False, "error": "empty"}), 400
 
-    if u["role"] == "student":
-        room = f"dm:{u['email']}"
-        role = "student"; user_id = u["email"]
-    elif u["role"] == "teacher":
-        student = body.get("student")
-        if not student:
-            return jsonify({"ok": False, "error": "no student"}), 400
-        room = f"dm:{student}"
-        role = "teacher"; user_id = u["email"]
-    else:
+    sender = _DM_SENDERS.get(u["role"])
+    if sender is None:
         return jsonify({"ok": False, "error": "forbidden"}), 403
-
-    con = db(); cur = con.cursor()
-    cur.execute("INSERT INTO chat_messages(room,user_id,role,text,ts) VALUES(?,?,?,?,?)",
-                (room, user_id, role, text, int(time.time())))
-    con.commit(); con.close()
-    return jsonify({"ok": True})
+    room, role, user_id = sender(u, body)
+    if room is None:
+        return jsonify({"ok": False, "error": "no student"}), 400
+
+    # Waits for the commit so the sender's next read sees the message; the
+    # writer thread still commits concurrent sends together.
+    ts = g.now
+    fut = writer.submit(lambda con: con.execute(_CHAT_INSERT_SQL, (room, user_id, role, text, ts)).lastrowid)
+    msg = {"from": role, "user": user_id, "text": text, "ts": ts}
+    try:
+        msg_id = fut.result(timeout=_DM_SEND_TIMEOUT)
+    except FutureTimeout:
+        fut.add_done_callback(lambda f: f.exception() is None and _dm_committed(room, {"id": f.result(), **msg}))
+        return jsonify({"ok": True, "queued": True})
+    except Exception as e:
+        print("[WARN] DM send failed:", e)
+        return jsonify({"ok": False, "error": "not saved"}), 500
+    _dm_committed(room, {"id": msg_id, **msg})
+    return jsonify({"ok": True, "id": msg_id})
 
 @app.route("/api/dm/me", methods=["GET"])
 def api_dm_me():
@@ -1150,38 +1994,52 @@ def api_dm_me():
     if not student:
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    con = db(); cur = con.cursor()
-    cur.execute("SELECT user_id,role,text,ts FROM chat_messages WHERE room=? ORDER BY ts ASC", (f"dm:{student}",))
-    msgs = [{"from": r[1], "user": r[0], "text": r[2], "ts": r[3]} for r in cur.fetchall()]
-    con.close()
-    return jsonify(msgs)
+    # ?after_id=<id> returns only newer messages plus a last_id cursor;
+    # without it the whole thread comes back as a bare list.
+    after_id = request.args.get("after_id", type=int)
+    if after_id is None:
+        return _conditional(app.response_class(_dm_thread_json(f"dm:{student}"), mimetype="application/json"))
+    msgs = _dm_thread(f"dm:{student}", after_id)
+    return _ojsonify({"messages": msgs, "last_id": msgs[-1]["id"] if msgs else after_id})
 
 @app.route("/api/dm/<student>", methods=["GET"])
 def api_dm_get(student):
     u = current_user()
     if not u:
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    msgs = d.get("dm", {}).get(student, [])[-200:]
-    return jsonify({"messages": msgs})
+    d = load_data()
+    msgs = d["dm"].get(student, [])[-200:]
+    since = request.args.get("since", type=int)
+    if since is None:
+        return _ojsonify({"messages": msgs})
+    msgs = [m for m in msgs if m.get("ts", 0) > since]
+    return _ojsonify({"messages": msgs, "max_ts": msgs[-1].get("ts", since) if msgs else since})
 
 @app.route("/api/dm/unread", methods=["GET"])
 def api_dm_unread():
-    d = ensure_keys(load_data())
+    d = load_data()
     out = {}
     for student, msgs in d.get("dm", {}).items():
         out[student] = sum(1 for m in msgs if m.get("from") == "student" and m.get("unread", True))
-    return jsonify(out)
+    # Polled by every open teacher page: let the browser reuse it for a few
+    # seconds, then revalidate (304 while the counts are unchanged).
+    resp = _ojsonify(out)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 5
+    return _conditional(resp)
 
 @app.route("/api/dm/mark_read", methods=["POST"])
 def api_dm_mark_read():
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     student = body.get("student")
-    d = ensure_keys(load_data())
-    if student in d.get("dm", {}):
-        for m in d["dm"][student]:
-            if m.get("from") == "student":
-                m["unread"] = False
+    d = load_data()
+    changed = False
+    for m in d["dm"].get(student, ()):
+        if m.get("from") == "student" and m.get("unread", True):
+            m["unread"] = False
+            changed = True
+    # Re-marking an already-read thread is the common case; nothing to save.
+    if changed:
         save_data(d)
     return jsonify({"ok": True})
 
@@ -1189,42 +2047,59 @@ def api_dm_mark_read():
 # =========================
 # Attention Check
 # =========================
+# Bumped when a check starts or a response arrives; /api/attention_results
+# keeps the encoded body (and its ETag) of the current version only.
+_ATTENTION_VERSION = 0
+_ATTENTION_BODY = {}
+
+def _bump_attention():
+    global _ATTENTION_VERSION
+    _ATTENTION_VERSION += 1
+
 @app.route("/api/attention_check", methods=["POST"])
 def api_attention_check():
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     title = body.get("title", "Are you paying attention?")
     timeout = int(body.get("timeout", 30))
 
-    d = ensure_keys(load_data())
-    d["attention_check"] = {"title": title, "timeout": timeout, "ts": int(time.time()), "responses": {}}
+    d = load_data()
+    d["attention_check"] = {"title": title, "timeout": timeout, "ts": g.now, "responses": {}}
 
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    d["pending_commands"].setdefault("*", []).append({
         "type": "attention_check",
         "title": title,
         "timeout": timeout
     })
+    log_action({"event": "attention_check_start", "title": title}, d)
     save_data(d)
-    log_action({"event": "attention_check_start", "title": title})
+    _bump_attention()
     return jsonify({"ok": True})
 
 @app.route("/api/attention_response", methods=["POST"])
 def api_attention_response():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     response = b.get("response", "")
-    d = ensure_keys(load_data())
+    d = load_data()
     check = d.get("attention_check")
     if not check:
         return jsonify({"ok": False, "error": "no active check"}), 400
-    check["responses"][student] = {"response": response, "ts": int(time.time())}
+    check["responses"][student] = {"response": response, "ts": g.now}
+    log_action({"event": "attention_response", "student": student, "response": response}, d)
     save_data(d)
-    log_action({"event": "attention_response", "student": student, "response": response})
+    _bump_attention()
     return jsonify({"ok": True})
 
 @app.route("/api/attention_results")
 def api_attention_results():
-    d = ensure_keys(load_data())
-    return jsonify(d.get("attention_check", {}))
+    version = _ATTENTION_VERSION
+    hit = _ATTENTION_BODY.get(version)
+    if hit is None:
+        body = orjson.dumps(load_data().get("attention_check", {}))
+        hit = (body, hashlib.md5(body).hexdigest())
+        _ATTENTION_BODY.clear()
+        _ATTENTION_BODY[version] = hit
+    return _conditional(app.response_class(hit[0], mimetype="application/json"), hit[1])
 
 
 # =========================
@@ -1235,40 +2110,59 @@ def api_student_set():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
+    d = load_data()
     ov = d.setdefault("student_overrides", {}).setdefault(student, {})
     if "focus_mode" in b:
         ov["focus_mode"] = bool(b.get("focus_mode"))
     if "paused" in b:
         ov["paused"] = bool(b.get("paused"))
+    log_action({"event": "student_set", "student": student, "focus_mode": ov.get("focus_mode"), "paused": ov.get("paused")}, d)
     save_data(d)
-    log_action({"event": "student_set", "student": student, "focus_mode": ov.get("focus_mode"), "paused": ov.get("paused")})
     return jsonify({"ok": True, "overrides": ov})
 
+@app.route("/api/student/set/batch", methods=["POST"])
+def api_student_set_batch():
+    """/api/student/set for many students in one request (class-wide focus/lock)."""
+    u = current_user()
+    if not u or u["role"] not in ("teacher", "admin"):
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    b = request.get_json(silent=True) or {}
+    students = [s.strip() for s in (b.get("students") or []) if isinstance(s, str) and s.strip()]
+    if not students:
+        return jsonify({"ok": False, "error": "students required"}), 400
+    d = load_data()
+    overrides = d.setdefault("student_overrides", {})
+    out = {}
+    for student in students:
+        ov = out[student] = overrides.setdefault(student, {})
+        if "focus_mode" in b:
+            ov["focus_mode"] = bool(b.get("focus_mode"))
+        if "paused" in b:
+            ov["paused"] = bool(b.get("paused"))
+    log_action({"event": "student_set", "students": len(out), "focus_mode": b.get("focus_mode"), "paused": b.get("paused")}, d)
+    save_data(d)
+    return jsonify({"ok": True, "overrides": out})
+
 @app.route("/api/open_tabs", methods=["POST"])
 def api_open_tabs_alias():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     urls = b.get("urls") or []
     student = (b.get("student") or "").strip()
     if not urls:
         return jsonify({"ok": False, "error": "urls required"}), 400
 
     d = load_data()
-    d.setdefault("pending_commands", {})
     if student:
-        pend = d.setdefault("pending_per_student", {})
-        arr = pend.setdefault(student, [])
-        arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-        arr[:] = arr[-50:]
-        log_action({"event": "student_tabs", "student": student, "type": "open_tabs", "count": len(urls)})
+        _queue_for_student(d, student, {"type": "open_tabs", "urls": urls, "ts": g.now})
+        log_action({"event": "student_tabs", "student": student, "type": "open_tabs", "count": len(urls)}, d)
     else:
-        d["pending_commands"].setdefault("*", []).append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-        log_action({"event": "class_tabs", "target": "*", "type": "open_tabs", "count": len(urls)})
-    save_data(d)
+        d["pending_commands"].setdefault("*", []).append({"type": "open_tabs", "urls": urls, "ts": g.now})
+        log_action({"event": "class_tabs", "target": "*", "type": "open_tabs", "count": len(urls)}, d)
+        save_data(d)
     return jsonify({"ok": True})
 
 @app.route("/api/student/tabs_action", methods=["POST"])
@@ -1276,18 +2170,14 @@ def api_student_tabs_action():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     action = (b.get("action") or "").strip()  # 'restore_tabs' | 'close_tabs'
     if not student or action not in ("restore_tabs", "close_tabs"):
         return jsonify({"ok": False, "error": "student and valid action required"}), 400
-    d = ensure_keys(load_data())
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": action, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
-    log_action({"event": "student_tabs", "student": student, "type": action})
+    d = load_data()
+    _queue_for_student(d, student, {"type": action, "ts": g.now})
+    log_action({"event": "student_tabs", "student": student, "type": action}, d)
     return jsonify({"ok": True})
 
 
@@ -1296,19 +2186,17 @@ def api_student_tabs_action():
 # =========================
 @app.route("/api/chat/<class_id>", methods=["GET", "POST"])
 def api_chat(class_id):
-    d = ensure_keys(load_data())
-    d.setdefault("chat", {}).setdefault(class_id, [])
+    d = load_data()
     if request.method == "POST":
-        b = request.json or {}
+        b = request.get_json(silent=True) or {}
         txt = (b.get("text") or "")[:500]
         sender = b.get("from") or "student"
         if not txt:
             return jsonify({"ok": False, "error": "empty"}), 400
-        d["chat"][class_id].append({"from": sender, "text": txt, "ts": int(time.time())})
-        d["chat"][class_id] = d["chat"][class_id][-200:]
-        save_data(d)
+        _log_event(d, "chat", {"from": sender, "text": txt, "ts": g.now}, class_id)
         return jsonify({"ok": True})
-    return jsonify({"enabled": d.get("settings", {}).get("chat_enabled", False), "messages": d["chat"][class_id][-100:]})
+    msgs = list(d["chat"].get(class_id, ()))[-100:]
+    return _ojsonify({"enabled": d.get("settings", {}).get("chat_enabled", False), "messages": msgs})
 
 
 # =========================
@@ -1316,35 +2204,25 @@ def api_chat(class_id):
 # =========================
 @app.route("/api/raise_hand", methods=["POST"])
 def api_raise_hand():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     note = (b.get("note") or "").strip()
-    d = ensure_keys(load_data())
-    d.setdefault("raises", [])
-    d["raises"].append({"student": student, "note": note, "ts": int(time.time())})
-    d["raises"] = d["raises"][-200:]
-    save_data(d)
-    log_action({"event": "raise_hand", "student": student})
+    d = load_data()
+    _log_event(d, "raises", {"student": student, "note": note, "ts": g.now})
+    log_action({"event": "raise_hand", "student": student}, d)
     return jsonify({"ok": True})
 
 @app.route("/api/raise_hand", methods=["GET"])
 def get_hands():
-    d = ensure_keys(load_data())
-    return jsonify({"hands": d.get("raises", [])})
+    d = load_data()
+    return _conditional(_ojsonify({"hands": list(d["raises"])}))
 
 @app.route("/api/raise_hand/clear", methods=["POST"])
 def clear_hand():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    lst = d.get("raises", [])
-    if student:
-        lst = [r for r in lst if r.get("student") != student]
-    else:
-        lst = []
-    d["raises"] = lst
-    save_data(d)
-    return jsonify({"ok": True, "remaining": len(lst)})
+    remaining = _clear_events(load_data(), "raises", student)
+    return jsonify({"ok": True, "remaining": remaining})
 
 
 # =========================
@@ -1353,15 +2231,15 @@ def clear_hand():
 @app.route("/api/youtube_rules", methods=["GET", "POST"])
 def api_youtube_rules():
     if request.method == "POST":
-        body = request.json or {}
+        body = request.get_json(silent=True) or {}
         set_setting("yt_block_keywords", body.get("block_keywords", []))
         set_setting("yt_block_channels", body.get("block_channels", []))
         set_setting("yt_allow", body.get("allow", []))
         set_setting("yt_allow_mode", bool(body.get("allow_mode", False)))
 
         # Broadcast an update command to all present students
-        d = ensure_keys(load_data())
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({
+        d = load_data()
+        d["pending_commands"].setdefault("*", []).append({
             "type": "update_youtube_rules",
             "rules": {
                 "block_keywords": body.get("block_keywords", []),
@@ -1370,9 +2248,9 @@ def api_youtube_rules():
                 "allow_mode": bool(body.get("allow_mode", False))
             }
         })
+        log_action({"event": "youtube_rules_update"}, d)
         save_data(d)
 
-        log_action({"event": "youtube_rules_update"})
         return jsonify({"ok": True})
 
     rules = {
@@ -1386,7 +2264,7 @@ def api_youtube_rules():
 @app.route("/api/doodle_block", methods=["GET", "POST"])
 def api_doodle_block():
     if request.method == "POST":
-        body = request.json or {}
+        body = request.get_json(silent=True) or {}
         enabled = bool(body.get("enabled", False))
         set_setting("block_google_doodles", enabled)
         log_action({"event": "doodle_block_update", "enabled": enabled})
@@ -1399,7 +2277,7 @@ def api_doodle_block():
 # =========================
 @app.route("/api/overrides", methods=["GET"])
 def api_get_overrides():
-    d = ensure_keys(load_data())
+    d = load_data()
     return jsonify({
         "allowlist": d.get("allowlist", []),
         "teacher_blocks": d.get("teacher_blocks", [])
@@ -1410,12 +2288,12 @@ def api_save_overrides():
     u = current_user()
     if not u or u["role"] != "admin":
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    b = request.json or {}
+    d = load_data()
+    b = request.get_json(silent=True) or {}
     d["allowlist"] = b.get("allowlist", [])
     d["teacher_blocks"] = b.get("teacher_blocks", [])
+    log_action({"event": "overrides_save"}, d)
     save_data(d)
-    log_action({"event": "overrides_save"})
     return jsonify({"ok": True})
 
 
@@ -1427,57 +2305,77 @@ def api_poll():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     q = (body.get("question") or "").strip()
     opts = [o.strip() for o in (body.get("options") or []) if o and o.strip()]
     if not q or not opts:
         return jsonify({"ok": False, "error": "question and options required"}), 400
     poll_id = "poll_" + str(int(time.time() * 1000))
-    d = ensure_keys(load_data())
+    d = load_data()
     d.setdefault("polls", {})[poll_id] = {"question": q, "options": opts, "responses": []}
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    d["pending_commands"].setdefault("*", []).append({
         "type": "poll", "id": poll_id, "question": q, "options": opts
     })
+    log_action({"event": "poll_create", "poll_id": poll_id}, d)
     save_data(d)
-    log_action({"event": "poll_create", "poll_id": poll_id})
     return jsonify({"ok": True, "poll_id": poll_id})
 
 @app.route("/api/poll_response", methods=["POST"])
 def api_poll_response():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     poll_id = b.get("poll_id")
     answer = b.get("answer")
     student = (b.get("student") or "").strip()
     if not poll_id:
         return jsonify({"ok": False, "error": "no poll id"}), 400
-    d = ensure_keys(load_data())
+    d = load_data()
     if poll_id not in d.get("polls", {}):
         return jsonify({"ok": False, "error": "unknown poll"}), 404
     d["polls"][poll_id].setdefault("responses", []).append({
         "student": student,
         "answer": answer,
-        "ts": int(time.time())
+        "ts": g.now
     })
+    log_action({"event": "poll_response", "poll_id": poll_id, "student": student}, d)
     save_data(d)
-    log_action({"event": "poll_response", "poll_id": poll_id, "student": student})
     return jsonify({"ok": True})
 
 
 # =========================
 # State (feature flags bucket)
 # =========================
+# /api/state ETag is "<boot nonce>-<store version>": the nonce keeps a restarted
+# process from matching tags handed out by the previous one. Deduped heartbeats
+# only refresh last_seen and don't bump the version, so it may lag by up to
+# _HB_DEDUPE_SECS in a cached body.
+_STATE_EPOCH = uuid.uuid4().hex[:8]
+_STATE_BODY = {}  # etag -> body of the latest /api/state response
+
 @app.route("/api/state")
 def api_state():
-    d = ensure_keys(load_data())
+    etag = f"{_STATE_EPOCH}-{_STORE.version}"
+    body = _STATE_BODY.get(etag)
+    if body is None:
+        body = _state_body()
+        _STATE_BODY.clear()
+        _STATE_BODY[etag] = body
+    return _conditional(app.response_class(body, mimetype="application/json"), etag, weak=True)
+
+def _state_body():
+    d = load_data()
     yt_rules = {
         "block": get_setting("yt_block_keywords", []),
         "allow": get_setting("yt_allow", []),
         "allow_mode": bool(get_setting("yt_allow_mode", False))
     }
-    features = d.setdefault("settings", {}).setdefault("features", {})
+    # d is the live store: build the response from copies so the injected
+    # rules never get written back.
+    out = dict(d)
+    out["settings"] = dict(out.get("settings") or {})
+    features = out["settings"]["features"] = dict(out["settings"].get("features") or {})
     features["youtube_rules"] = yt_rules
     features.setdefault("youtube_filter", True)
-    return jsonify(d)
+    return orjson.dumps(out, default=list, option=orjson.OPT_NON_STR_KEYS)
 
 
 # =========================
@@ -1489,18 +2387,14 @@ def api_student_open_tabs():
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
 
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     urls = b.get("urls") or []
     if not student or not urls:
         return jsonify({"ok": False, "error": "student and urls required"}), 400
 
     d = load_data()
-    pend = d.setdefault("pending_per_student", {})
-    arr = pend.setdefault(student, [])
-    arr.append({"type": "open_tabs", "urls": urls, "ts": int(time.time())})
-    arr[:] = arr[-50:]
-    save_data(d)
+    _queue_for_student(d, student, {"type": "open_tabs", "urls": urls, "ts": g.now})
     return jsonify({"ok": True})
 
 
@@ -1512,42 +2406,40 @@ def api_exam():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    body = request.json or {}
+    body = request.get_json(silent=True) or {}
     action = (body.get("action") or "").strip()
     url = (body.get("url") or "").strip()
-    d = ensure_keys(load_data())
+    d = load_data()
     if action == "start":
         if not url:
             return jsonify({"ok": False, "error": "url required"}), 400
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "exam_start", "url": url})
+        d["pending_commands"].setdefault("*", []).append({"type": "exam_start", "url": url})
         d.setdefault("exam_state", {})["active"] = True
         d["exam_state"]["url"] = url
+        log_action({"event": "exam", "action": "start", "url": url}, d)
         save_data(d)
-        log_action({"event": "exam", "action": "start", "url": url})
         return jsonify({"ok": True})
     elif action == "end":
-        d.setdefault("pending_commands", {}).setdefault("*", []).append({"type": "exam_end"})
+        d["pending_commands"].setdefault("*", []).append({"type": "exam_end"})
         d.setdefault("exam_state", {})["active"] = False
+        log_action({"event": "exam", "action": "end"}, d)
         save_data(d)
-        log_action({"event": "exam", "action": "end"})
         return jsonify({"ok": True})
     return jsonify({"ok": False, "error": "invalid action"}), 400
 
 @app.route("/api/exam_violation", methods=["POST"])
 def api_exam_violation():
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
     url = (b.get("url") or "").strip()
     reason = (b.get("reason") or "tab_violation").strip()
     if not student:
         return jsonify({"ok": False, "error": "student required"}), 400
-    d = ensure_keys(load_data())
-    d.setdefault("exam_violations", []).append({
-        "student": student, "url": url, "reason": reason, "ts": int(time.time())
+    d = load_data()
+    _log_event(d, "exam_violations", {
+        "student": student, "url": url, "reason": reason, "ts": g.now
     })
-    d["exam_violations"] = d["exam_violations"][-500:]
-    save_data(d)
-    log_action({"event": "exam_violation", "student": student, "reason": reason})
+    log_action({"event": "exam_violation", "student": student, "reason": reason}, d)
     return jsonify({"ok": True})
 
 @app.route("/api/exam_violations", methods=["GET"])
@@ -1555,23 +2447,19 @@ def api_exam_violations():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    d = ensure_keys(load_data())
-    return jsonify({"ok": True, "items": d.get("exam_violations", [])[-200:]})
+    d = load_data()
+    return _conditional(_ojsonify({"ok": True, "items": list(d["exam_violations"])[-200:]}))
 
 @app.route("/api/exam_violations/clear", methods=["POST"])
 def api_exam_violations_clear():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     student = (b.get("student") or "").strip()
-    d = ensure_keys(load_data())
-    if student:
-        d["exam_violations"] = [v for v in d.get("exam_violations", []) if v.get("student") != student]
-    else:
-        d["exam_violations"] = []
-    save_data(d)
-    log_action({"event": "exam_violations_clear", "student": student or "*"})
+    d = load_data()
+    _clear_events(d, "exam_violations", student)
+    log_action({"event": "exam_violations_clear", "student": student or "*"}, d)
     return jsonify({"ok": True})
 
 
@@ -1583,15 +2471,15 @@ def api_notify():
     u = current_user()
     if not u or u["role"] not in ("teacher", "admin"):
         return jsonify({"ok": False, "error": "forbidden"}), 403
-    b = request.json or {}
+    b = request.get_json(silent=True) or {}
     title = (b.get("title") or "G School")[:120]
     message = (b.get("message") or "")[:500]
-    d = ensure_keys(load_data())
-    d.setdefault("pending_commands", {}).setdefault("*", []).append({
+    d = load_data()
+    d["pending_commands"].setdefault("*", []).append({
         "type": "notify", "title": title, "message": message
     })
+    log_action({"event": "notify", "title": title}, d)
     save_data(d)
-    log_action({"event": "notify", "title": title})
     return jsonify({"ok": True})
 
 
@@ -1609,21 +2497,21 @@ except Exception as _e:
 # Run
 # =========================
 if __name__ == "__main__":
-    # Ensure data.json exists and is sane on boot
-    save_data(ensure_keys(load_data()))
+    # Ensure the state table exists and is sane on boot (imports data.json once)
+    save_data(load_data())
     app.run(host="0.0.0.0", port=5000, debug=True)
 
 
 
 @app.route("/api/present/<room>/diag", methods=["GET"])
 def api_present_diag(room):
-    room = re.sub(r'[^a-zA-Z0-9_-]+', '', room)
-    r = PRESENT.get(room) or {"offers":{}, "answers":{}, "cand_v":{}, "cand_t":{}, "active": False}
+    room = _safe_id(room)
+    r = _present_room(room) or PresentRoom()
     return jsonify({
         "ok": True,
-        "active": bool(r.get("active")),
-        "offers": len(r.get("offers", {})),
-        "answers": len(r.get("answers", {})),
-        "cand_v": {k: len(v) for k,v in (r.get("cand_v") or {}).items()},
-        "cand_t": {k: len(v) for k,v in (r.get("cand_t") or {}).items()},
+        "active": bool(r.active),
+        "offers": len(r.offers),
+        "answers": len(r.answers),
+        "cand_v": {k: len(v) for k,v in r.cand_v.items()},
+        "cand_t": {k: len(v) for k,v in r.cand_t.items()},
     })
@@ -0,0 +1,231 @@
+"""
+db_pool.py
+Process-wide SQLite access shared by app.py and ai_routes.py.
+Read-only connections are pooled and reused so SQLite keeps its page cache
+between requests instead of paying open()/close() on every handler.
+All writes go through `writer`, a single thread that owns the only
+writing connection and commits queued work in batches, so request
+threads never contend for the write lock (no SQLITE_BUSY).
+Also holds a small TTL read cache for rarely-changing rows (settings,
+category rules) that both modules invalidate on write.
+"""
+
+import atexit
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(__file__)
+DB_PATH = os.path.join(ROOT, "gschool.db")
+
+# Applied to every new connection (journal_mode=WAL is persisted in the file).
+# WAL + synchronous=NORMAL: readers don't block the writer and commits skip
+# the second fsync; busy_timeout waits out short write locks instead of failing.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+
+
+def _connect(path, readonly=False):
+    # Connections live for the whole process, so a larger statement cache
+    # keeps every hot query prepared after its first use.
+    if readonly:
+        uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+    else:
+        con = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    for p in PRAGMAS:
+        if readonly and p.startswith("PRAGMA journal_mode"):
+            continue  # persisted in the file; set by the writer
+        con.execute(p)
+    return con
+
+
+class ConnectionPool:
+    """Small LIFO pool of read-only sqlite3 connections for one database file."""
+
+    def __init__(self, path, size=8):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                con = _connect(self.path, readonly=True)
+                self._all.append(con)
+                return con
+        return self._idle.get()
+
+    def release(self, con):
+        # Never hand out a connection with an open read transaction.
+        if con.in_transaction:
+            con.rollback()
+        self._idle.put(con)
+
+    @contextmanager
+    def checkout(self):
+        """Borrow a reader connection for the duration of the block."""
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close_all(self):
+        with self._lock:
+            for con in self._all:
+                try:
+                    con.close()
+                except Exception:
+                    pass
+            self._all = []
+            self._idle = queue.LifoQueue()
+
+
+class TTLCache:
+    """{key: (value, expires_at)} with a fixed TTL; loaders run on miss."""
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        hit = self._items.get(key)
+        now = time.monotonic()
+        if hit and hit[1] > now:
+            return hit[0]
+        value = loader()
+        with self._lock:
+            self._items[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything when key is None."""
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+
+class WriteQueue:
+    """Single writer thread owning the only connection that writes.
+
+    submit(fn) queues fn(con) and returns a Future. The thread takes
+    everything queued so far and runs it inside one BEGIN IMMEDIATE ...
+    COMMIT, each item under its own SAVEPOINT so a failing write only
+    rolls back itself. Futures resolve once the batch has committed.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path, max_batch=500):
+        self.path = path
+        self.max_batch = max_batch
+        self._q = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def submit(self, fn):
+        if self._thread is None:
+            self._start()
+        fut = Future()
+        self._q.put((fn, fut))
+        return fut
+
+    def run(self, fn):
+        """Queue fn(con) and block until it has been committed."""
+        return self.submit(fn).result()
+
+    def execute(self, sql, params=()):
+        return self.run(lambda con: con.execute(sql, params).rowcount)
+
+    def executemany(self, sql, rows):
+        return self.run(lambda con: con.executemany(sql, rows).rowcount)
+
+    def enqueue(self, sql, params=()):
+        """Fire-and-forget write; committed with the next batch."""
+        self.submit(lambda con: con.execute(sql, params))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        con = _connect(self.path)
+        while True:
+            batch = [self._q.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self._q.get_nowait())
+            except queue.Empty:
+                pass
+            stop = any(item is self._STOP for item in batch)
+            batch = [item for item in batch if item is not self._STOP]
+            if batch:
+                self._commit(con, batch)
+            if stop:
+                con.close()
+                return
+
+    def _commit(self, con, batch):
+        results = []
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            for fn, fut in batch:
+                con.execute("SAVEPOINT w")
+                try:
+                    res = fn(con)
+                except Exception as e:
+                    con.execute("ROLLBACK TO w")
+                    con.execute("RELEASE w")
+                    results.append((fut, None, e))
+                else:
+                    con.execute("RELEASE w")
+                    results.append((fut, res, None))
+            con.commit()
+        except Exception as e:
+            if con.in_transaction:
+                con.rollback()
+            print("[WARN] write batch failed:", e)
+            for _, fut in batch:
+                fut.set_exception(e)
+            return
+        for fut, res, err in results:
+            if err is None:
+                fut.set_result(res)
+            else:
+                fut.set_exception(err)
+
+    def close(self):
+        """Commit whatever is still queued and stop the writer thread."""
+        if self._thread is not None and self._thread.is_alive():
+            self._q.put(self._STOP)
+            self._thread.join(timeout=5)
+
+
+pool = ConnectionPool(DB_PATH)
+writer = WriteQueue(DB_PATH)
+settings_cache = TTLCache(ttl=5.0)
+atexit.register(pool.close_all)